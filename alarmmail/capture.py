@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os, os.path, glob, mmap, struct, time
+
+# Each capture file starts with _MAGIC followed by records.
+# A name record assigns an index to a PV name.  Names are
+# written again in each file so that every file can be read alone.
+#   'N' index namelen name
+#   'U' index rxtime timestamp severity status ok valuelen value
+# rxtime is the local time when the update was received.
+_MAGIC = 'AMCAP1\n'
+_NAME = struct.Struct('!cIH')
+_UPDATE = struct.Struct('!cIddBBBH')
+
+class CaptureLog(object):
+    """Record every CA update received, for later replay.
+
+    Records are buffered in memory and written when 'bufsize'
+    bytes are waiting, or every 'period' seconds.
+    Files are rotated after 'filesize' bytes, keeping at most 'nfiles'.
+    """
+    def __init__(self, dirname, filesize=64*2**20, nfiles=4, bufsize=2**16, period=1.0):
+        self.dirname = dirname
+        self.filesize, self.nfiles, self.bufsize = filesize, max(1, nfiles), bufsize
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        files = self.files(dirname)
+        self._num = int(os.path.basename(files[-1])[:8])+1 if files else 0
+        self._FP, self._names, self._size = None, {}, 0
+        self._buf, self._nbuf = [], 0
+        self._open()
+
+        import cothread
+        self.period, self._stop = period, False
+        self._wake = cothread.Event(auto_reset=False)
+        self._T = cothread.Spawn(self._run)
+
+    @staticmethod
+    def files(dirname):
+        return sorted(glob.glob(os.path.join(dirname, '[0-9]'*8+'.cap')))
+
+    def record(self, data):
+        """Called from PV._update()
+        """
+        idx = self._names.get(data.name)
+        if idx is None:
+            idx = self._names[data.name] = len(self._names)
+            self._buf.append(_NAME.pack('N', idx, len(data.name)))
+            self._buf.append(data.name)
+            self._nbuf += _NAME.size+len(data.name)
+        if data.ok:
+            S = str(data)
+            self._buf.append(_UPDATE.pack('U', idx, time.time(), data.timestamp,
+                                          data.severity, data.status, 1, len(S)))
+        else:
+            S = ''
+            self._buf.append(_UPDATE.pack('U', idx, time.time(), 0.0, 0, 0, 0, 0))
+        self._buf.append(S)
+        self._nbuf += _UPDATE.size+len(S)
+        if self._nbuf>=self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if not self._buf:
+            return
+        buf, self._buf, self._nbuf = ''.join(self._buf), [], 0
+        self._FP.write(buf)
+        self._FP.flush()
+        self._size += len(buf)
+        if self._size>=self.filesize:
+            self._open()
+
+    def close(self):
+        self._stop = True
+        self._wake.Signal()
+        self._T.Wait()
+        self.flush()
+        self._FP.close()
+
+    def _open(self):
+        if self._FP is not None:
+            self._FP.close()
+        fname = os.path.join(self.dirname, '%08d.cap'%self._num)
+        self._num += 1
+        LOG.debug('Capturing to %s', fname)
+        self._FP = open(fname, 'wb')
+        self._FP.write(_MAGIC)
+        self._names, self._size = {}, len(_MAGIC)
+        for old in self.files(self.dirname)[:-self.nfiles]:
+            LOG.debug('Removing old capture %s', old)
+            os.remove(old)
+
+    def _run(self):
+        import cothread
+        while not self._stop:
+            try:
+                self._wake.Wait(self.period)
+            except cothread.Timedout:
+                pass
+            try:
+                self.flush()
+            except:
+                LOG.exception('Failed to write capture')
+
+class CapturedValue(str):
+    """An update read back from a capture file.
+    Behaves like a cothread.catools value.
+    """
+    update_count = 1
+    units = ''
+    def __new__(cls, value, name, rxtime, timestamp, severity, status, ok):
+        self = str.__new__(cls, value)
+        self.name, self.rxtime, self.timestamp = name, rxtime, timestamp
+        self.severity, self.status, self.ok = severity, status, ok
+        return self
+
+def read(fname):
+    """Yield CapturedValue for each update in a capture file
+    """
+    with open(fname, 'rb') as FP:
+        if os.fstat(FP.fileno()).st_size<=len(_MAGIC):
+            return
+        M = mmap.mmap(FP.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if M[:len(_MAGIC)]!=_MAGIC:
+            raise ValueError('%s is not a capture file'%fname)
+        names, pos, end = {}, len(_MAGIC), len(M)
+        while pos<end:
+            kind = M[pos]
+            if kind=='N':
+                if pos+_NAME.size>end:
+                    break
+                _k, idx, N = _NAME.unpack_from(M, pos)
+                pos += _NAME.size
+                names[idx] = M[pos:pos+N]
+                pos += N
+            elif kind=='U':
+                if pos+_UPDATE.size>end:
+                    break
+                _k, idx, RT, T, sevr, stat, ok, N = _UPDATE.unpack_from(M, pos)
+                pos += _UPDATE.size
+                if pos+N>end:
+                    break
+                yield CapturedValue(M[pos:pos+N], names[idx], RT, T, sevr, stat, bool(ok))
+                pos += N
+            else:
+                raise ValueError('%s: corrupt record at %d'%(fname, pos))
+        if pos!=end:
+            LOG.warning('%s: ignoring truncated record at %d', fname, pos)
+    finally:
+        M.close()
+
+def replay(path, speed=1.0):
+    """Yield (time offset, CapturedValue) from a capture file,
+    or all files in a capture directory, with the offsets
+    between reception times divided by 'speed'.
+    """
+    files = CaptureLog.files(path) if os.path.isdir(path) else [path]
+    T0 = None
+    for fname in files:
+        for V in read(fname):
+            if T0 is None:
+                T0 = V.rxtime
+            yield max(0.0, V.rxtime-T0)/speed, V
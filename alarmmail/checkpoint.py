@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os, marshal, time
+
+from . import util
+from .state import DISCONN
+
+# file is _MAGIC followed by a marshal'd
+#   {pv name:(ok, severity, status, timestamp, value)}
+_MAGIC = 'AMCKP1\n'
+
+class SavedValue(object):
+    """Last value of a PV before the daemon was restarted.
+    Used to seed PV._prev
+    """
+    __slots__ = ('name', 'ok', 'severity', 'status', 'timestamp', 'value')
+    update_count = 1
+    units = ''
+    def __init__(self, name, ok, severity, status, timestamp, value):
+        self.name, self.ok = name, ok
+        self.severity, self.status, self.timestamp, self.value = severity, status, timestamp, value
+    def __str__(self):
+        return self.value
+
+def snapshot(pvs):
+    """Collect the last value of each PV.
+    PVs which have never connected are saved as disconnected.
+    """
+    state = {}
+    for P in pvs:
+        V = P._prev
+        if V is not None and V.ok:
+            state[P._name] = (True, V.severity, V.status, V.timestamp, util.valuestr(V, P._meta))
+        else:
+            state[P._name] = (False, DISCONN, 0, 0.0, '')
+    return state
+
+def save(fname, state):
+    """Atomically replace the checkpoint file
+    """
+    data = marshal.dumps(state)
+    with open(fname+'.tmp', 'wb') as FP:
+        FP.write(_MAGIC)
+        FP.write(data)
+        FP.flush()
+        os.fsync(FP.fileno())
+    os.rename(fname+'.tmp', fname)
+
+def load(fname):
+    """Returns {pv name:SavedValue}.  Empty if the checkpoint
+    is missing or unreadable.
+    """
+    try:
+        with open(fname, 'rb') as FP:
+            data = FP.read()
+        if not data.startswith(_MAGIC):
+            raise ValueError('Not a checkpoint file')
+        state = marshal.loads(data[len(_MAGIC):])
+    except IOError as e:
+        LOG.info('No checkpoint loaded from %s: %s', fname, e)
+        return {}
+    except (ValueError, EOFError, TypeError) as e:
+        LOG.warning('Ignoring invalid checkpoint %s: %s', fname, e)
+        return {}
+    return dict([(name, SavedValue(name, *V)) for name, V in state.iteritems()])
+
+def seed(pvs, saved):
+    """Seed PVs (before subscribing) with values from load()
+    """
+    T0, N = time.time(), 0
+    for P in pvs:
+        V = saved.get(P._name)
+        if V is not None:
+            P._seed(V)
+            N += 1
+    LOG.info('Seeded %d of %d PVs from checkpoint in %.3f sec', N, len(pvs), time.time()-T0)
+
+class Checkpointer(object):
+    """Periodically save the state of PVs returned by pvsfn()
+    """
+    def __init__(self, fname, pvsfn, period=60.0):
+        self.fname, self._pvsfn, self.period = fname, pvsfn, period
+        import cothread
+        self._stop = cothread.Event(auto_reset=False)
+        self._T = cothread.Spawn(self._run)
+
+    def save(self):
+        T0 = time.time()
+        state = snapshot(self._pvsfn())
+        # file I/O off the scheduler
+        util.blocking(save, self.fname, state)
+        LOG.debug('Checkpoint of %d PVs in %.3f sec', len(state), time.time()-T0)
+
+    def close(self):
+        """Stop, and save a final checkpoint
+        """
+        self._stop.Signal()
+        self._T.Wait()
+        save(self.fname, snapshot(self._pvsfn()))
+
+    def _run(self):
+        import cothread
+        while True:
+            try:
+                self._stop.Wait(self.period)
+                return
+            except cothread.Timedout:
+                pass
+            try:
+                self.save()
+            except:
+                LOG.exception('Failed to write checkpoint %s', self.fname)
@@ -9,6 +9,7 @@ import logging
 LOG = logging.getLogger(__name__)
 
 import re, os, os.path, itertools
+from collections import namedtuple
 
 from ConfigParser import SafeConfigParser as ConfigParser, NoOptionError, NoSectionError
 
@@ -137,16 +138,59 @@ class PVNode(object):
         self.desc = dict([(p,d) for p,d in itertools.izip(iter(pvlist), iter(desclist))])
         self.oninitial = C.getbool('alarminitial',False)
 
+        # flap detection.  Disabled when flapHigh is 0
+        self.flapwindow = C.getdouble('flapWindow', 600.0)
+        self.flaphigh = C.getint('flapHigh', 0)
+        self.flaplow = C.getint('flapLow', self.flaphigh//2)
+        if self.flaphigh and not 0<=self.flaplow<self.flaphigh:
+            raise ValueError("Group %s must have 0 <= flapLow < flapHigh"%C.name)
+
+    def update(self, other):
+        """Take settings from another node of the same group
+        """
+        self.__dict__.update(other.__dict__)
+
+# A priority lane of a destination.  Events of at least 'sevr' are
+# queued and mailed separately with their own delay, holdoff and qsize.
+Lane = namedtuple('Lane', ['name', 'sevr', 'delay', 'holdoff', 'qsize'])
+
 class DestNode(object):
     def __init__(self, C):
         self.name = C.name
         self.mto = splitaddr(C.get('to',''))
         self.mfrom = C.get('from', '"Alarm Mailer" <mailer@localhost>')
-        self.msubject = C.get('subject', '%(cnt)d Alarm Events')
+        self.mode = C.get('mode', 'queue')
+        if self.mode not in ('queue', 'digest'):
+            raise ValueError('Destination %s has unknown mode %s'%(C.name, self.mode))
+        self.period = C.getdouble('period', 3600.0)
+        if self.mode=='digest':
+            self.msubject = C.get('subject', '%(cnt)d PVs in alarm, %(transitions)d events')
+        else:
+            self.msubject = C.get('subject', '%(cnt)d Alarm Events')
 
         self.delay = C.getdouble('delay', 300.0)
         self.holdoff = C.getdouble('holdoff', 900.0)
         self.qsize = C.getint('queueSize', 200)
+        self.coalesce = C.getbool('coalesce', False)
+        self.adaptive = C.getbool('adaptive', False)
+        self.mindelay = C.getdouble('minDelay', 10.0)
+        self.minholdoff = C.getdouble('minHoldoff', 60.0)
+
+        self.lanes = []
+        for spec in C.get('lanes', '').split():
+            name, _, sevr = spec.partition(':')
+            try:
+                sevr = int(sevr)
+            except ValueError:
+                sevr = -1
+            if not name or sevr<1 or sevr>4:
+                raise ValueError('Destination %s lane "%s" must be name:severity with severity 1-4'%(C.name, spec))
+            self.lanes.append(Lane(name, sevr,
+                                   C.getdouble(name+'Delay', 10.0),
+                                   C.getdouble(name+'Holdoff', 60.0),
+                                   C.getint(name+'QueueSize', self.qsize)))
+        # most severe first
+        self.lanes.sort(key=lambda L:-L.sevr)
 
         self.groups = C.get('groups','').split(' ')
 
@@ -168,6 +212,8 @@ def loadconfig(cfile):
     if not main.has_section('main'):
         raise ValueError('%s: missing [main]'%cfile)
     MS = SectionProxy(main, 'main')
+    if MS.get('monitorEvents', 'value') not in ('value', 'alarm'):
+        raise ValueError('%s: monitorEvents must be value or alarm'%cfile)
 
     confdir = os.path.dirname(cfile)
     
@@ -8,10 +8,71 @@ See license in README
 import logging
 LOG = logging.getLogger(__name__)
 
-import sys, os, os.path, atexit, time
+import sys, os, os.path, atexit, time, threading, Queue
 
 _FMT = "%(asctime)s %(levelname)s:%(message)s"
 
+class AsyncHandler(logging.Handler):
+    """Pass log records to a background thread which writes
+    them with the target handler, so that callers never wait for
+    disk I/O.  At most 'maxsize' records are buffered.  Further records
+    are dropped and counted, and the count is logged once there is room.
+    """
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target, self.maxsize = target, maxsize
+        self.dropped = 0
+        self._start()
+
+    def _start(self):
+        self._Q = Queue.Queue(self.maxsize)
+        self._T = threading.Thread(target=self._run, name='logwriter')
+        self._T.daemon = True
+        self._T.start()
+
+    def afterfork(self):
+        """The writer thread does not survive fork().  Call in the child.
+        """
+        self.createLock()
+        self.target.createLock()
+        self._start()
+
+    def emit(self, record):
+        try:
+            # format arguments now as they may change before being written
+            if record.args:
+                record.msg, record.args = record.getMessage(), None
+            if record.exc_info:
+                if not record.exc_text:
+                    record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+                record.exc_info = None
+            self._Q.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except:
+            self.handleError(record)
+
+    def _run(self):
+        reported = 0
+        while True:
+            rec = self._Q.get()
+            if rec is None:
+                break
+            if self.dropped!=reported:
+                N, reported = self.dropped-reported, self.dropped
+                self.target.handle(logging.LogRecord(LOG.name, logging.WARNING, __file__, 0,
+                                                     '%d log messages dropped', (N,), None))
+            self.target.handle(rec)
+
+    def close(self):
+        """Write out buffered records
+        """
+        if self._T.is_alive():
+            self._Q.put(None)
+            self._T.join(5.0)
+        self.target.close()
+        logging.Handler.close(self)
+
 class UserNotify(object):
     """Handle for the daemon (grandchild) process to send
     messages back to the parent.  Also used
@@ -130,7 +191,8 @@ def daemonize(opts):
     fmt = logging.Formatter(_FMT)
     handler = RotatingFileHandler(logfile, maxBytes=100000, backupCount=5)
     handler.setFormatter(fmt)
-    root.addHandler(handler)
+    # file writes, and rotation, happen in a background thread
+    root.addHandler(AsyncHandler(handler, maxsize=opts.log_queue))
     root.setLevel(logging.DEBUG)
     WR.msg("Logging initialized to %s"%logfile)
 
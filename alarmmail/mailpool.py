@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import time, socket, smtplib, threading
+
+# Errors which mean the session is no longer usable
+SessionErrors = (smtplib.SMTPException, socket.error)
+
+class SMTPPool(object):
+    """Keep warm SMTP sessions for re-use between batches.
+
+    Sessions idle for longer than 'idletime' are closed.
+    A session idle for more than 'checktime' is probed
+    with NOOP before being handed out again.
+
+    May be used from several threads.
+    """
+    def __init__(self, connect, size=1, idletime=60.0, checktime=5.0):
+        self._connect = connect
+        self.size, self.idletime, self.checktime = size, idletime, checktime
+        self._idle = [] # [(last use, session)] with the most recent last
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return a usable session, connecting if none are idle
+        """
+        now = time.time()
+        self.expire(now)
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                T, conn = self._idle.pop()
+            if now-T < self.checktime or self._alive(conn):
+                return conn
+            LOG.debug('Dropping stale SMTP session')
+            self._close(conn)
+        LOG.debug('Opening SMTP session')
+        return self._connect()
+
+    def put(self, conn):
+        """Return a healthy session to the pool
+        """
+        with self._lock:
+            if len(self._idle)<self.size:
+                self._idle.append((time.time(), conn))
+                return
+        self._quit(conn)
+
+    def discard(self, conn):
+        """Forget a session which has failed
+        """
+        self._close(conn)
+
+    def expire(self, now=None):
+        """Close sessions which have been idle for too long
+        """
+        now = now or time.time()
+        with self._lock:
+            old = [conn for T, conn in self._idle if now-T >= self.idletime]
+            self._idle = self._idle[len(old):]
+        for conn in old:
+            self._quit(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _T, conn in idle:
+            self._quit(conn)
+
+    @staticmethod
+    def _alive(conn):
+        try:
+            return conn.noop()[0]==250
+        except SessionErrors:
+            return False
+
+    @staticmethod
+    def _quit(conn):
+        try:
+            conn.quit()
+        except SessionErrors:
+            SMTPPool._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except SessionErrors:
+            pass
@@ -10,24 +10,285 @@ LOG = logging.getLogger(__name__)
 
 import sys, os
 
-from . import config, mailtest, util
+from . import config, mailtest, util, simulate
+
+class AlarmDaemon(object):
+    """The running daemon.  Owns the mail server queue,
+    the destination Notifiers, and the PVs of each group.
+    """
+    def __init__(self, C, workers=None):
+        from . import notifier, pv
+        self.C = C
+        self.workers = workers # [shard.Worker] when PVs are monitored by worker processes
+        self.agg = None
+        self.mailer = notifier.EmailServer(C['mail'])
+        self.fetcher = pv.MetaFetcher(ttl=C['main'].getdouble('metaTTL', 3600.0))
+        self.notifiers = {} # {dest name:Notifier}
+        self.fanouts = {}   # {group name:NotifyFanout}
+        self.registry = pv.Registry(self.fetcher, pv.Options.fromconfig(C['main'])) # one PV per unique name
+        self.pvs = {}       # {group name:{pv name:PV}}
+        self.checkpoint = None
+
+    def start(self, done):
+        from . import notifier, pv
+        C = self.C
+
+        for name, destnode in C['dest'].iteritems():
+            self.notifiers[name] = notifier.create(destnode, self.mailer)
+
+        if self.workers:
+            return self._startsharded(done)
+
+        pvs = []
+        # the first group listing a PV gives its flap settings
+        for pvnodename in sorted(C['pv']):
+            pvnode = C['pv'][pvnodename]
+            pvs.extend(self._addpvs(pvnodename, pvnode, pvnode.pvs))
+        self._wire()
+
+        fname = C['main'].get('checkpoint')
+        if fname:
+            from . import checkpoint
+            checkpoint.seed(pvs, checkpoint.load(fname))
+            self.checkpoint = checkpoint.Checkpointer(fname, self.allpvs,
+                                                      C['main'].getdouble('checkpointPeriod', 60.0))
+
+        # notify interested parties that we are running
+        for dest in self.notifiers.itervalues():
+            if dest._conf.oninitial:
+                dest.add(util.InternalEvent(util.RES_START))
+
+        done.msg("Subscribing to %d PVs in %d groups"%(len(pvs), len(C['pv'])))
+        pv.subscribe(pvs, self.registry.opts)
+
+        done.msg("Waiting for PVs to connect")
+        self._initialwait(pvs, done.msg)
+
+    def _startsharded(self, done):
+        import cothread
+        from . import pv, shard
+        C = self.C
+        for pvnodename in C['pv']:
+            self.fanouts[pvnodename] = pv.NotifyFanout()
+        self._wire()
+        self.agg = shard.Aggregator(self.workers, C, self.fanouts)
+
+        fname = C['main'].get('checkpoint')
+        if fname:
+            from . import checkpoint
+            self.checkpoint = checkpoint.Checkpointer(fname, self.allpvs,
+                                                      C['main'].getdouble('checkpointPeriod', 60.0))
+
+        for dest in self.notifiers.itervalues():
+            if dest._conf.oninitial:
+                dest.add(util.InternalEvent(util.RES_START))
+
+        done.msg("Waiting for %d workers to connect PVs"%len(self.workers))
+        try:
+            self.agg.ready.Wait(C['main'].getdouble('initialwait', 10.0)+30.0)
+        except cothread.Timedout:
+            LOG.error('Only %d of %d workers ready', self.agg.nready, len(self.workers))
+
+    def _initialwait(self, pvs, progress=None):
+        initialwait(pvs, self.C['main'], progress)
+
+    def allpvs(self):
+        if self.agg is not None:
+            for P in self.agg.allpvs():
+                yield P
+            return
+        for P in self.registry.itervalues():
+            yield P
+
+    def _addpvs(self, pvnodename, pvnode, names):
+        from . import pv
+        try:
+            node = self.fanouts[pvnodename]
+        except KeyError:
+            node = self.fanouts[pvnodename] = pv.NotifyFanout()
+        G = self.pvs.setdefault(pvnodename, {})
+        new = self.registry.add(pvnode, node, names)
+        for name in names:
+            G[name] = self.registry[name]
+        return new
+
+    def _wire(self):
+        """(re)build the mapping from PV group to destination
+        """
+        for node in self.fanouts.itervalues():
+            del node._listeners[:]
+        for dest in self.notifiers.itervalues():
+            for pvg in dest._conf.groups:
+                self.fanouts[pvg].add_notify(dest)
+        for pvnodename, node in self.fanouts.iteritems():
+            if not node._listeners:
+                LOG.warning("PV group %s not referenced by any destinations", pvnodename)
+
+    def reload(self, C):
+        """Apply a new configuration.  Only added or removed PVs are
+        (un)subscribed.  Events queued for destinations which remain
+        are kept.
+        """
+        import time
+        from . import notifier, pv
+        T0 = time.time()
+        old = self.C
+        nadd = ndel = 0
+
+        if self.workers:
+            # PVs are in the workers, which have the original configuration.
+            changed = [G for G in set(old['pv'])|set(C['pv'])
+                       if G not in old['pv'] or G not in C['pv'] or vars(old['pv'][G])!=vars(C['pv'][G])]
+            if changed:
+                LOG.warning('Changes to PV groups %s require a restart with workers', ', '.join(sorted(changed)))
+            for dest in C['dest'].itervalues():
+                for G in dest.groups:
+                    if G not in old['pv']:
+                        raise ValueError('Destination %s references new PV group %s'%(dest.name, G))
+            C['pv'] = old['pv']
+        self.C = C
+
+        new = []
+        if not self.workers:
+            # PV groups
+            for pvnodename in set(self.pvs)-set(C['pv']):
+                ndel += self.registry.remove(pvnodename, self.pvs.pop(pvnodename))
+                del self.fanouts[pvnodename]
+
+            for pvnodename in sorted(C['pv']):
+                pvnode = C['pv'][pvnodename]
+                G = self.pvs.get(pvnodename)
+                if G is None:
+                    new.extend(self._addpvs(pvnodename, pvnode, pvnode.pvs))
+                    continue
+                oldnode = old['pv'][pvnodename]
+                names = set(pvnode.pvs)
+                gone = set(G)-names
+                for name in gone:
+                    del G[name]
+                ndel += self.registry.remove(pvnodename, gone)
+                # existing PVs keep a reference to the old node
+                oldnode.update(pvnode)
+                new.extend(self._addpvs(pvnodename, oldnode, names-set(G)))
+                C['pv'][pvnodename] = oldnode
+            nadd = len(new)
+
+        # destinations
+        for name in set(self.notifiers)-set(C['dest']):
+            LOG.info('Removing destination %s', name)
+            self.notifiers.pop(name).close()
+        for name, destnode in C['dest'].iteritems():
+            dest = self.notifiers.get(name)
+            if dest is None:
+                LOG.info('Adding destination %s', name)
+                self.notifiers[name] = notifier.create(destnode, self.mailer)
+            elif dest._conf.mode!=destnode.mode:
+                LOG.info('Replacing destination %s', name)
+                dest.close()
+                self.notifiers[name] = notifier.create(destnode, self.mailer)
+            elif vars(dest._conf)!=vars(destnode):
+                LOG.info('Updating destination %s', name)
+                dest.reconfigure(destnode)
+
+        self._wire()
+
+        opts = pv.Options.fromconfig(C['main'])
+        if opts!=self.registry.opts:
+            if self.workers:
+                LOG.warning('Changes to pvLogBurst, pvLogPeriod, monitorEvents, and nativeType require a restart with workers')
+            elif self.registry.configure(opts):
+                LOG.info('Subscribed again to %d PVs for the new monitorEvents or nativeType', len(self.registry)-len(new))
+        pv.subscribe(new, self.registry.opts)
+        LOG.info('Reloaded configuration in %.3f sec. %d PVs added, %d removed',
+                 time.time()-T0, nadd, ndel)
+
+        if new:
+            import cothread
+            cothread.Spawn(self._initialwait, new)
+
+    def close(self):
+        """Unsubscribe, then flush queued events and mail
+        """
+        if self.workers:
+            from . import shard
+            if self.agg is not None:
+                self.agg.close()
+            shard.stop(self.workers)
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        for dest in self.notifiers.itervalues():
+            dest.freeze()
+        self.registry.close()
+        self.fetcher.close()
+        for dest in self.notifiers.itervalues():
+            dest.close()
+        self.mailer.close()
+
+def initialwait(pvs, MS, progress=None):
+    """Wait for newly subscribed PVs to connect, then
+    send events for those which have not.
+    """
+    from . import pv
+    pv.waitconnect(pvs, MS.getdouble('initialwait', 10.0),
+                   settle=MS.getdouble('initialsettle', 1.0),
+                   progress=progress)
+
+    # notify of initially disconnected, unless they were already
+    # disconnected before a restart.
+    ndis = 0
+    for apv in pvs:
+        if apv._sub is None:
+            continue
+        elif apv._seeded:
+            if not apv._prev.ok:
+                continue
+            # was connected before the restart
+            apv._unseed()
+        elif apv._prev is not None:
+            continue
+        ndis += 1
+        apv._send(util.DummyValue(apv._name), util.RES_DISCONN)
+
+    LOG.info("%d disconnected PVs", ndis)
+
+def confpaths(C, cfile):
+    """File and directory names in [main] are relative to the
+    directory of the main configuration file.
+    """
+    MS, confdir = C['main'], os.path.dirname(os.path.abspath(cfile))
+    for key in ('captureDir', 'checkpoint'):
+        if MS.get(key):
+            MS.set(key, os.path.join(confdir, MS.get(key)))
 
 def rundaemon(opts, C):
-    import daemonize
+    import daemonize, signal, cothread
+
+    # daemonize() changes directory
+    opts.config = os.path.abspath(opts.config)
+
+    reload = cothread.Event()
+    def hup(sig,frame):
+        reload.Signal()
+    signal.signal(signal.SIGHUP, hup)
 
     if opts.daemonize:
         done = daemonize.daemonize(opts)
-        import signal
         def handler(sig,frame):
-            import cothread
             cothread.Quit()
-        signal.signal(signal.SIGHUP, handler)
         signal.signal(signal.SIGINT, handler)
         signal.signal(signal.SIGTERM, handler)
 
     else:
         done = daemonize.NullNotify()
 
+    confpaths(C, opts.config)
+
+    workers = None
+    if C['main'].getint('workers', 0)>0:
+        # before any other cothreads are started
+        from . import shard
+        workers = shard.fork(C, C['main'].getint('workers'))
+
     LOG.info('initialize coselect')
     from cothread.coselect import select_hook
     select_hook()
@@ -37,56 +298,25 @@ def rundaemon(opts, C):
     try:
         util.djangosetup(opts)
 
-        from . import notifier
+        from . import metrics, state, pv
+        MS = C['main']
+        if MS.getint('metricsPort'):
+            metrics.serve(MS.getint('metricsPort'), MS.get('metricsAddress', '127.0.0.1'),
+                          routes=state.routes())
+        for H in logging.getLogger().handlers:
+            if isinstance(H, daemonize.AsyncHandler):
+                metrics.REGISTRY.gauge('alarmmail_log_dropped', 'Log messages dropped',
+                                       fn=lambda H=H:H.dropped)
+        if MS.get('metricsFile'):
+            metrics.writer(MS.get('metricsFile'), MS.getdouble('metricsPeriod', 15.0))
+        if MS.get('captureDir') and not workers:
+            from . import capture
+            pv._capture = capture.CaptureLog(MS.get('captureDir'),
+                                             filesize=MS.getint('captureSize', 64)*2**20,
+                                             nfiles=MS.getint('captureFiles', 4))
 
-        mailer = notifier.EmailServer(C['mail'])
-#        done.done(0, 'Setup complete')
-
-        notifiers = [notifier.Notifier(destnode, mailer) for destnode in C['dest'].itervalues()]
-
-        # build the reverse mapping from PV Group config to destination        
-        pvg2dest = {}
-        for dest in notifiers:
-            for pvg in dest._conf.groups:
-                try:
-                    L = pvg2dest[pvg]
-                except KeyError:
-                    L = pvg2dest[pvg] = []
-                L.append(dest)
-
-        from . import pv
-
-        pvs = []
-        for pvnodename, pvnode in C['pv'].iteritems():
-            node = pv.NotifyFanout()
-            pvs.extend([pv.PV(name, pvnode, node) for name in pvnode.pvs])
-            try:
-                dests = pvg2dest[pvnodename]
-            except KeyError:
-                LOG.warning("PV group %s not referenced by any destinations", pvnodename)
-            else:
-                for dest in dests:
-                    node.add_notify(dest)
-
-        # notify interested parties that we are running
-        for dest in notifiers:
-            if dest._conf.oninitial:
-                dest.add(util.InternalEvent(util.RES_START))
-
-        done.msg("Waiting for PVs to connect")
-
-        #TODO smarter wait...
-        import cothread
-        cothread.Sleep(C['main'].getdouble('initialwait', 1.0))
-
-        # notify of initially disconnected
-        ndis = 0
-        for apv in pvs:
-            if apv._prev is None:
-                ndis += 1
-                apv._notify.add(util.AlarmEvent(util.DummyValue(apv._name), None, util.RES_DISCONN, apv._conf))
-
-        LOG.info("%d disconnected PVs", ndis)
+        D = AlarmDaemon(C, workers)
+        D.start(done)
 
         done.done(0, 'Setup complete')
     except:
@@ -94,9 +324,30 @@ def rundaemon(opts, C):
         raise
     done = True
 
-    import cothread
+    def reloader():
+        while True:
+            reload.Wait()
+            LOG.info('Reloading configuration from %s', opts.config)
+            try:
+                C = config.loadconfig(opts.config)
+                confpaths(C, opts.config)
+                D.reload(C)
+            except:
+                LOG.exception('Reload failed.  Keeping current configuration')
+    cothread.Spawn(reloader)
+
     cothread.WaitForQuit()
 
+    # stops workers, saves the checkpoint, and sends queued events
+    LOG.info('Stopping')
+    try:
+        D.close()
+    except:
+        LOG.exception('Error while stopping')
+
+    if pv._capture is not None:
+        pv._capture.close()
+
 def getopts():
     from argparse import ArgumentParser
     parser = ArgumentParser()
@@ -119,6 +370,8 @@ def getopts():
                       help="Write daemon process id to this file")
     daemon.add_argument('-U','--user',metavar='USER[:GROUP]',
                       help='Switch to this user (and group) after starting')
+    daemon.add_argument('--log-queue', type=int, default=10000, metavar='N',
+                      help='Buffer at most N log messages when daemonized (default: %(default)s)')
     daemon.set_defaults(action=rundaemon)
 
     # test mail sender
@@ -136,6 +389,45 @@ def getopts():
     ttest.add_argument('--to', default='someone@xyz', help='Destination address(es)')
     ttest.add_argument('templatefile')
     ttest.set_defaults(action=mailtest.expand)
+
+    # load test with simulated PVs and mail server
+    bench = subp.add_parser('benchmark', help='Measure throughput and latency with simulated PVs')
+    bench.add_argument('--pvs', type=int, default=1000, help='Number of PVs (default: %(default)s)')
+    bench.add_argument('--groups', type=int, default=10, help='Number of PV groups (default: %(default)s)')
+    bench.add_argument('--overlap', type=int, default=1,
+                       help='Number of groups listing each PV (default: %(default)s)')
+    bench.add_argument('--dests', type=int, default=4, help='Number of destinations (default: %(default)s)')
+    bench.add_argument('--rate', type=float, default=1000.0, help='Alarm transitions per second (default: %(default)s)')
+    bench.add_argument('--flap', type=float, default=0.5, metavar='FRAC',
+                       help='Fraction of transitions which repeat the previous PV (default: %(default)s)')
+    bench.add_argument('--duration', type=float, default=10.0, help='Seconds of updates (default: %(default)s)')
+    bench.add_argument('--delay', type=float, default=1.0, help='Destination and mail delay (default: %(default)s)')
+    bench.add_argument('--holdoff', type=float, default=2.0, help='Destination and mail holdoff (default: %(default)s)')
+    bench.add_argument('--adaptive', action='store_true', default=False,
+                       help='Adapt delay and holdoff to the event rate (see adaptive)')
+    bench.add_argument('--min-delay', type=float, default=0.2, help='Adaptive minimum delay (default: %(default)s)')
+    bench.add_argument('--min-holdoff', type=float, default=0.5, help='Adaptive minimum holdoff (default: %(default)s)')
+    bench.add_argument('--queue-size', type=int, default=200, help='Destination queueSize (default: %(default)s)')
+    bench.add_argument('--urgent', type=int, default=0, metavar='SEVR',
+                       help='Add a lane for events of at least this severity (see lanes)')
+    bench.add_argument('--urgent-delay', type=float, default=0.1, help='Lane delay (default: %(default)s)')
+    bench.add_argument('--urgent-holdoff', type=float, default=0.5, help='Lane holdoff (default: %(default)s)')
+    bench.add_argument('--coalesce', action='store_true', default=False, help='Coalesce events per PV')
+    bench.add_argument('--noise', type=float, default=0.0,
+                       help='Value only updates per second, in addition to --rate (default: %(default)s)')
+    bench.add_argument('--alarm-only', action='store_true', default=False,
+                       help='Monitor with DBE_ALARM (see monitorEvents)')
+    bench.add_argument('--native', action='store_true', default=False,
+                       help='Monitor native type values (see nativeType)')
+    bench.add_argument('--stream', metavar='FILE',
+                       help='Replay transitions from a file with lines of "<sec> <pvname> <severity>"')
+    bench.add_argument('--workers', type=int, default=0,
+                       help='Monitor PVs in this many worker processes (default: %(default)s)')
+    bench.add_argument('--replay', metavar='PATH',
+                       help='Replay updates from a capture file or directory (see captureDir)')
+    bench.add_argument('--speed', type=float, default=1.0,
+                       help='Replay speed up factor (default: %(default)s)')
+    bench.set_defaults(action=simulate.benchmark, noconfig=True)
     
     return parser.parse_args()
 
@@ -144,7 +436,10 @@ def main(opts=None):
         opts = getopts()
     logging.basicConfig(level=logging.DEBUG)
 
-    C = config.loadconfig(opts.config)
+    if getattr(opts, 'noconfig', False):
+        C = None # self-contained
+    else:
+        C = config.loadconfig(opts.config)
     if opts.check_config:
         sys.exit(0)
 
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os
+from collections import OrderedDict
+
+class Counter(object):
+    kind = 'counter'
+    __slots__ = ('value',)
+    def __init__(self):
+        self.value = 0
+    def inc(self, n=1):
+        self.value += n
+    def samples(self):
+        return [('', self.value)]
+
+class Gauge(object):
+    """Either set directly, or computed by calling fn() when collected
+    """
+    kind = 'gauge'
+    __slots__ = ('value', 'fn')
+    def __init__(self, fn=None):
+        self.value, self.fn = 0, fn
+    def inc(self, n=1):
+        self.value += n
+    def dec(self, n=1):
+        self.value -= n
+    def set(self, v):
+        self.value = v
+    def samples(self):
+        return [('', self.fn() if self.fn else self.value)]
+
+class Summary(object):
+    """Count and sum of observations (eg. durations)
+    """
+    kind = 'summary'
+    __slots__ = ('count', 'sum')
+    def __init__(self):
+        self.count, self.sum = 0, 0.0
+    def observe(self, v):
+        self.count += 1
+        self.sum += v
+    def samples(self):
+        return [('_count', self.count), ('_sum', self.sum)]
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = OrderedDict() # {name:(help, kind, {labels:metric})}
+
+    def counter(self, name, help, **labels):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, fn=None, **labels):
+        G = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            G.fn = fn
+        return G
+
+    def summary(self, name, help, **labels):
+        return self._get(Summary, name, help, labels)
+
+    def _get(self, klass, name, help, labels):
+        try:
+            _help, kind, M = self._metrics[name]
+        except KeyError:
+            _help, kind, M = self._metrics[name] = (help, klass.kind, OrderedDict())
+        if kind!=klass.kind:
+            raise ValueError('%s is already a %s'%(name, kind))
+        key = tuple(sorted(labels.iteritems()))
+        try:
+            return M[key]
+        except KeyError:
+            ret = M[key] = klass()
+            return ret
+
+    def remove(self, **labels):
+        """Forget all metrics with these labels
+        """
+        labels = set(labels.iteritems())
+        for _help, _kind, M in self._metrics.itervalues():
+            for key in [K for K in M if labels.issubset(K)]:
+                del M[key]
+
+    def expose(self):
+        """Render all metrics in the Prometheus text format
+        """
+        out = []
+        for name, (help, kind, M) in self._metrics.iteritems():
+            out.append('# HELP %s %s'%(name, help))
+            out.append('# TYPE %s %s'%(name, kind))
+            for key, metric in M.items():
+                labels = ','.join(['%s="%s"'%(K, str(V).replace('\\','\\\\').replace('"','\\"'))
+                                   for K,V in key])
+                if labels:
+                    labels = '{%s}'%labels
+                try:
+                    samples = metric.samples()
+                except:
+                    LOG.exception('Failed to collect %s%s', name, labels)
+                    continue
+                for suffix, val in samples:
+                    out.append('%s%s%s %s'%(name, suffix, labels, repr(float(val))))
+        out.append('')
+        return '\n'.join(out)
+
+    def write(self, fname):
+        """Atomically (re)write the named file
+        """
+        with open(fname+'.tmp', 'w') as FP:
+            FP.write(self.expose())
+        os.rename(fname+'.tmp', fname)
+
+REGISTRY = Registry()
+
+def writer(fname, period=15.0, registry=REGISTRY):
+    """Periodically write metrics to a text file (eg. for the
+    node_exporter textfile collector).
+    """
+    import cothread
+    def run():
+        while True:
+            try:
+                registry.write(fname)
+            except:
+                LOG.exception('Failed to write metrics to %s', fname)
+            cothread.Sleep(period)
+    return cothread.Spawn(run)
+
+def serve(port, address='127.0.0.1', registry=REGISTRY, routes={}):
+    """Serve metrics over HTTP.
+
+    Other paths are served by routes {path:fn}.  fn(query)
+    is passed the parsed query string and returns (content type, body).
+
+    Connections are handled by threads, so that a slow client
+    does not stall the cothread scheduler.  Bodies are made by
+    calling fn in the scheduler thread.
+    """
+    import cothread, urlparse, threading, socket
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+    def metrics(query):
+        return 'text/plain; version=0.0.4', registry.expose()
+
+    class Handler(BaseHTTPRequestHandler):
+        timeout = 2.0
+        def do_GET(self):
+            url = urlparse.urlparse(self.path)
+            fn = routes.get(url.path, metrics)
+            try:
+                ctype, body = cothread.CallbackResult(fn, urlparse.parse_qs(url.query),
+                                                      callback_timeout=10.0)
+            except:
+                LOG.exception('Error serving %s', self.path)
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, fmt, *args):
+            LOG.debug('%s '+fmt, self.client_address[0], *args)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        closed = False
+        def server_close(self):
+            self.closed = True
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR) # wake accept()
+            except socket.error:
+                pass
+            HTTPServer.server_close(self)
+        def handle_error(self, request, client_address):
+            # eg. a client which timed out
+            LOG.debug('Error serving %s', client_address[0], exc_info=True)
+
+    serv = Server((address, port), Handler)
+    LOG.info('Serving metrics on %s:%d', address, serv.server_port)
+    def run():
+        # not serve_forever(), which would call the select() of cothread.coselect
+        while not serv.closed:
+            serv._handle_request_noblock() # blocks in accept()
+    T = threading.Thread(target=run, name='metrics')
+    T.daemon = True
+    T.start()
+    return serv
@@ -8,22 +8,27 @@ See license in README
 import logging
 LOG = logging.getLogger(__name__)
 
-import time
+import time, smtplib, threading, Queue
 
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
+from email.utils import parseaddr
 
-from . import util
+from . import util, mailpool, metrics, state
 
 #import django.template.loader as loader
 
 class EmailServer(util.WorkerQueue):
+    _SPOOLED = object() # wakeup marker placed in the in-memory queue
     def __init__(self, S):
         util.WorkerQueue.__init__(self,
                                   delay=S.getdouble('delay',30.0),
                                   holdoff=S.getdouble('holdoff',30.0),
-                                  qsize=S.getint('queueSize',10))
-        import smtplib
+                                  qsize=S.getint('queueSize',10),
+                                  name='EmailServer',
+                                  adaptive=S.getbool('adaptive', False),
+                                  mindelay=S.getdouble('minDelay', 1.0),
+                                  minholdoff=S.getdouble('minHoldoff', 5.0))
         self.timeout = S.getint('timeout', 15)
         self.server = S.get('server','localhost')
         self.port = S.get('port', None)
@@ -32,52 +37,406 @@ class EmailServer(util.WorkerQueue):
         if proto not in ['ESMTP']:
             raise ValueError('mail protocol %s not supported'%proto)
         self._transport = smtplib.SMTP
+        self.concurrency = max(1, S.getint('concurrency', 1))
+        self._pool = mailpool.SMTPPool(self._connect,
+                                       size=S.getint('poolSize', self.concurrency),
+                                       idletime=S.getdouble('idleTime', 60.0),
+                                       checktime=S.getdouble('checkTime', 5.0))
+
+        R = metrics.REGISTRY
+        self._m_send = R.summary('alarmmail_smtp_send_seconds', 'Time to send one mail')
+        self._m_fail = R.counter('alarmmail_smtp_failures_total', 'Mails refused or SMTP sessions failed')
+
+        self.retrymin = S.getdouble('retryMin', 30.0)
+        self.retrymax = S.getdouble('retryMax', 3600.0)
+        self._backoff, self._retryat = 0.0, 0.0
+        self._spool = None
+        if S.get('spool'):
+            from .spool import MailSpool
+            self._spool = MailSpool(S.get('spool'))
+            if self._spool.pending:
+                LOG.info('Replaying %d spooled mails', self._spool.pending)
+                self._kick()
+
+    def close(self):
+        util.WorkerQueue.close(self)
+        self._pool.close()
+        if self._spool is not None:
+            self._spool.close()
+
+    def add(self, evt, urgent=False):
+        """Queue a mail.  Urgent mails are sent without waiting
+        for the delay or holdoff.
+        """
+        if self._spool is None:
+            ok = util.WorkerQueue.add(self, evt)
+        else:
+            # With a spool, the in-memory queue only holds a wakeup marker
+            mfrom, mto, msg = evt
+            self._spool.append(mfrom, mto, msg.as_string())
+            self._kick()
+            ok = True
+        if urgent:
+            self.flush()
+        return ok
+
+    def _kick(self):
+        if not self._Q:
+            util.WorkerQueue.add(self, self._SPOOLED)
+
+    def _connect(self):
+        return self._transport(self.server, self.port, timeout=self.timeout)
 
     def process(self, evts, overflow):
+        if self._spool is not None:
+            return self._processspool()
+
         LOG.info('Sending %d mails',len(evts))
         if overflow:
             LOG.warning('Lost some mails from queue overflow')
-        if self.nosend:            
+
+        retry = util.blocking(self._send, evts)
+        failed = [R for R in retry if R]
+        if failed:
+            LOG.error('Lost %d mails to %d recipients', len(failed), sum(map(len, failed)))
+
+    def _processspool(self):
+        if time.time() < self._retryat:
+            return # waiting for retry timer
+
+        self._spool.sync()
+        while self._spool.pending:
+            recs = self._spool.peek(self.qsize)
+            LOG.info('Sending %d of %d spooled mails', len(recs), self._spool.pending)
+            evts = [R for R, _pos in recs]
+            retry = util.blocking(self._send, evts)
+            # re-queue only the recipients which failed
+            nretry = 0
+            for (mfrom, _mto, msg), R in zip(evts, retry):
+                if R:
+                    self._spool.append(mfrom, R, msg)
+                    nretry += 1
+            self._spool.commit(recs[-1][1])
+            if nretry:
+                break
+        else:
+            self._backoff = 0.0
+            return
+
+        # retry later with exponential backoff
+        self._backoff = min(self.retrymax, max(self.retrymin, 2*self._backoff))
+        self._retryat = time.time()+self._backoff
+        LOG.warning('%d mails remain spooled, retry in %.0f sec', self._spool.pending, self._backoff)
+        import cothread
+        cothread.Timer(self._backoff, self._kick)
+
+    def _send(self, evts):
+        """Deliver messages using up to 'concurrency' SMTP sessions in parallel.
+        Recipients are grouped by domain, and each session
+        handles one domain at a time.
+        Called in a worker thread.
+
+        Returns a list with the recipients of each message
+        which should be retried.
+        """
+        retry = [[] for E in evts]
+        if self.nosend:
             for mfrom, mto, msg in evts:
                 LOG.debug('From: %s To: %s\n%s\n', mfrom, mto, msg)
-            return
+            return retry
+
+        T0 = time.time()
+        jobs = {} # {domain:[(index, mfrom, [rcpt], msg)]}
+        for i, (mfrom, mto, msg) in enumerate(evts):
+            if not isinstance(msg, str):
+                msg = msg.as_string()
+            bydom = {}
+            for R in mto:
+                bydom.setdefault(_domain(R), []).append(R)
+            for D, rcpts in bydom.iteritems():
+                jobs.setdefault(D, []).append((i, mfrom, rcpts, msg))
+
+        Q = Queue.Queue()
+        for D, job in jobs.iteritems():
+            Q.put((D, job))
+        def worker():
+            while True:
+                try:
+                    D, job = Q.get_nowait()
+                except Queue.Empty:
+                    return
+                self._sendjob(D, job, retry)
+
+        nthread = min(self.concurrency, len(jobs))
+        if nthread<=1:
+            worker()
+        else:
+            workers = [threading.Thread(target=worker, name='smtp%d'%n) for n in range(nthread)]
+            [W.start() for W in workers]
+            [W.join() for W in workers]
 
-        conn = self._transport(self.server, self.port, timeout=self.timeout)
-        for mfrom, mto, msg in evts:
-            #LOG.debug('From: %s To: %s\n%s\n', mfrom, mto, msg)
-            conn.sendmail(mfrom, mto, msg.as_string())
-        conn.quit()
+        T = time.time()-T0
+        N = len([R for R in retry if not R])
+        LOG.info('Sent %d mails in %.3f sec (%.1f/sec)', N, T, N/max(T, 1e-6))
+        return retry
+
+    def _sendjob(self, domain, job, retry):
+        """Send mails to recipients in one domain over one pooled session.
+        Reconnect once if the session fails part way through.
+        """
+        N, again = 0, True
+        while N<len(job):
+            conn = None
+            try:
+                conn = self._pool.get()
+                while N<len(job):
+                    i, mfrom, rcpts, msg = job[N]
+                    T1 = time.time()
+                    try:
+                        refused = conn.sendmail(mfrom, rcpts, msg)
+                    except smtplib.SMTPRecipientsRefused as e:
+                        refused = e.recipients
+                    except (smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as e:
+                        # message refused, but session is still usable
+                        refused = dict.fromkeys(rcpts, (e.smtp_code, e.smtp_error))
+                    self._m_send.observe(time.time()-T1)
+                    for R, (code, err) in refused.iteritems():
+                        self._m_fail.inc()
+                        if code>=500:
+                            LOG.error('Server refused mail to %s: %s %s', R, code, err)
+                        else:
+                            LOG.warning('Server deferred mail to %s: %s %s', R, code, err)
+                            retry[i].append(R)
+                    N += 1
+            except mailpool.SessionErrors:
+                self._m_fail.inc()
+                if conn is not None:
+                    self._pool.discard(conn)
+                if not again:
+                    LOG.exception('Failed to send %d of %d mails to %s', len(job)-N, len(job), domain)
+                    for i, _mfrom, rcpts, _msg in job[N:]:
+                        retry[i].extend(rcpts)
+                    break
+                again = False
+                LOG.warning('SMTP session failed after %d of %d mails to %s, reconnecting',
+                            N, len(job), domain)
+            except Exception:
+                # unexpected.  The session may be part way through a mail
+                self._m_fail.inc()
+                if conn is not None:
+                    self._pool.discard(conn)
+                LOG.exception('Error sending %d of %d mails to %s', len(job)-N, len(job), domain)
+                for i, _mfrom, rcpts, _msg in job[N:]:
+                    retry[i].extend(rcpts)
+                break
+            else:
+                self._pool.put(conn)
+
+def _domain(addr):
+    """
+    >>> _domain('"Last, First" <First.Last@XYZ.com>')
+    'xyz.com'
+    >>> _domain('someone')
+    ''
+    """
+    user, _at, dom = parseaddr(addr)[1].rpartition('@')
+    return dom.lower() if user else ''
 
 class Notifier(util.WorkerQueue):
     def __init__(self, C, serv):
         util.WorkerQueue.__init__(self,
                                   delay=C.delay,
                                   holdoff=C.holdoff,
-                                  qsize=C.qsize)
-        from django.template import loader
+                                  qsize=C.qsize,
+                                  coalesce=C.coalesce,
+                                  name=C.name,
+                                  adaptive=C.adaptive,
+                                  mindelay=C.mindelay,
+                                  minholdoff=C.minholdoff)
+        self._m_render = metrics.REGISTRY.summary('alarmmail_render_seconds', 'Time to render one notification', dest=C.name)
+        from .render import loader
         self._conf, self.server = C, serv
         self._loader = loader
+        self._lanes = self._mklanes(C)
 
-    def process(self, evts, overflow):
+    def _mklanes(self, C):
+        # digests are not split by severity
+        return [Lane(self, L) for L in C.lanes] if C.mode=='queue' else []
+
+    def reconfigure(self, C):
+        if C.lanes!=self._conf.lanes:
+            # queued events are sent by close()
+            for L in self._lanes:
+                L.close()
+            self._lanes = self._mklanes(C)
+        else:
+            for L, LC in zip(self._lanes, C.lanes):
+                L.configure(LC.delay, LC.holdoff, LC.qsize, C.coalesce)
+        self._conf = C
+        self.configure(delay=C.delay,
+                       holdoff=C.holdoff,
+                       qsize=C.qsize,
+                       coalesce=C.coalesce,
+                       adaptive=C.adaptive,
+                       mindelay=C.mindelay,
+                       minholdoff=C.minholdoff)
+
+    def add(self, evt):
+        for L in self._lanes:
+            if evt.sevr>=L.sevr:
+                return L.add(evt)
+        return util.WorkerQueue.add(self, evt)
+
+    def close(self):
+        for L in self._lanes:
+            L.close()
+        util.WorkerQueue.close(self)
+
+    def freeze(self):
+        """Called at exit before PVs are unsubscribed
+        """
+        pass
+
+    def process(self, evts, overflow, **extra):
         LOG.info('%s processing %d events', self, len(evts))
 
         msg = MIMEMultipart('alternative')
 
         # take mail header directly from configuration
-        msg['Subject'] = self._conf.msubject%{'cnt':len(evts),'name':self._conf.name}
+        msg['Subject'] = self._conf.msubject%{'cnt':len(evts),'name':self._conf.name,
+                                              'transitions':extra.get('transitions', len(evts)),
+                                              'lane':extra.get('lane', '')}
         msg['From'] = self._conf.mfrom
         msg['To'] = ', '.join(self._conf.mto)
 
+        T0 = time.time()
         # the template context.
         ctxt = {'events':evts, 'notifier':self._conf, 'now':time.ctime()}
+        ctxt.update(extra)
         # render to text for both mime types
         filename = self._conf.plain
         msg.attach(MIMEText(self._loader.render_to_string(filename, ctxt), 'plain'))
         filename = self._conf.html
         msg.attach(MIMEText(self._loader.render_to_string(filename, ctxt), 'html'))
+        self._m_render.observe(time.time()-T0)
 
-        if not self.server.add((self._conf.mfrom, self._conf.mto, msg)):
+        if not self.server.add((self._conf.mfrom, self._conf.mto, msg), urgent='lane' in extra):
             LOG.error("Failed to Q '%s' to: %s", msg['Subject'], msg['To'])
 
     def __repr__(self):
         return 'Notifier(%s)'%self._conf.name
+
+class Lane(util.WorkerQueue):
+    """Priority lane of a Notifier.  Queues events of at least
+    the lane severity, which are mailed by the Notifier, so that
+    they are not delayed or dropped behind less severe events.
+    """
+    def __init__(self, dest, L):
+        util.WorkerQueue.__init__(self,
+                                  delay=L.delay,
+                                  holdoff=L.holdoff,
+                                  qsize=L.qsize,
+                                  coalesce=dest._conf.coalesce,
+                                  name='%s/%s'%(dest._conf.name, L.name))
+        self._dest, self.lane, self.sevr = dest, L.name, L.sevr
+
+    def process(self, evts, overflow):
+        self._dest.process(evts, overflow, lane=self.lane)
+
+    def __repr__(self):
+        return 'Lane(%s)'%self.name
+
+class DigestNotifier(Notifier):
+    """Send one mail every 'period' seconds listing the PVs
+    currently in alarm, taken from the state index, and the number
+    of transitions since the previous digest.
+
+    A summary is kept only for PVs whose last event was an alarm,
+    so memory is bounded by the number of PVs in alarm.  Events of
+    other PVs are only counted.
+    """
+    def __init__(self, C, serv):
+        self._summ, self._ntrans, self._since = {}, 0, time.time()
+        self._frozen = None # [(PV, PVNode)] in alarm at exit, see freeze()
+        Notifier.__init__(self, C, serv)
+        self._schedule(self._IDLE, self._conf.period)
+
+    def close(self):
+        Notifier.close(self)
+        try:
+            self.digest()
+        except:
+            LOG.exception('%s Failed to send digest', self)
+
+    def freeze(self):
+        """Take the PVs in alarm for the final digest from the
+        state index now, as closing a PV removes it from the index.
+        """
+        self._frozen = self._alarmed()
+
+    def _alarmed(self):
+        """[(PV, PVNode)] of PVs in alarm
+        """
+        return [(P, state.INDEX.node(G)) for G in self._conf.groups
+                for P in state.INDEX.alarmed(G)]
+
+    def add(self, evt):
+        # a PV may be in more than one group
+        K = (evt.name, getattr(evt, 'conf', None))
+        self._ntrans += 1
+        if not evt.sevr:
+            # not in alarm, so not listed in the digest
+            self._summ.pop(K, None)
+            return True
+        S = self._summ.get(K)
+        if S is None:
+            self._summ[K] = util.EventSummary(evt)
+        else:
+            S.update(evt)
+        return True
+
+    def digest(self):
+        summ, self._summ = self._summ, {}
+        ntrans, self._ntrans = self._ntrans, 0
+        since, self._since = self._since, time.time()
+
+        alarmed = self._alarmed() if self._frozen is None else self._frozen
+        evts = []
+        for P, node in alarmed:
+            S = summ.get((P._name, node))
+            if S is None:
+                # in alarm since before the last digest
+                V = P._prev if P._prev is not None else util.DummyValue(P._name)
+                S = util.AlarmEvent(V, P._meta, util.RES_DISCONN if P._code==state.DISCONN else util.RES_ALARM, node,
+                                    P._fetcher.cached)
+            evts.append(S)
+
+        if not evts and not ntrans:
+            return
+        self.process(evts, False, digest=True, transitions=ntrans, since=time.ctime(since))
+
+    def _expire(self):
+        self._timer, self._state = None, self._BUSY
+        import cothread
+        cothread.Spawn(self._process, None)
+
+    def _process(self, _Q):
+        try:
+            self.digest()
+        except:
+            LOG.exception('%s Failed to send digest', self)
+        self._state = self._IDLE
+        if self._done is not None:
+            self._done.Signal()
+        else:
+            self._schedule(self._IDLE, self._conf.period)
+
+    def __repr__(self):
+        return 'DigestNotifier(%s)'%self._conf.name
+
+def create(C, serv):
+    """Make the Notifier for a destination
+    """
+    if C.mode=='digest':
+        return DigestNotifier(C, serv)
+    return Notifier(C, serv)
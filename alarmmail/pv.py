@@ -8,7 +8,16 @@ See license in README
 import logging
 LOG = logging.getLogger(__name__)
 
-from . import util
+import time, itertools
+
+from . import util, metrics, state
+
+_M_UPDATES = metrics.REGISTRY.counter('alarmmail_pv_updates_total', 'CA monitor updates received')
+_M_LOST = metrics.REGISTRY.counter('alarmmail_pv_lost_total', 'CA monitor updates with update_count!=1')
+_M_CONN = metrics.REGISTRY.gauge('alarmmail_pv_connected', 'PVs currently connected')
+_M_DISCONN = metrics.REGISTRY.gauge('alarmmail_pv_disconnected', 'PVs currently disconnected')
+_M_FLAPPING = metrics.REGISTRY.gauge('alarmmail_pv_flapping', 'PVs currently flapping')
+_M_SUPPRESSED = metrics.REGISTRY.counter('alarmmail_pv_suppressed_total', 'Events suppressed while flapping')
 
 class NotifyFanout(object):
     def __init__(self):
@@ -21,66 +30,493 @@ class NotifyFanout(object):
             Qd &= l.add(evt)
         return Qd
 
-class PV(object):
-    def __init__(self, pvname, conf, notify):
+_ca = None
+
+def catools():
+    """The CA client module.  cothread.catools unless
+    replaced (see simulate.install())
+    """
+    if _ca is None:
         from cothread import catools as ca
-        self._name, self._notify, self._conf = pvname, notify, conf
+        return ca
+    return _ca
+
+# capture.CaptureLog which records all updates, or None
+_capture = None
+
+class Options(object):
+    """Settings from the [main] section which apply to all PVs
+    """
+    def __init__(self, logburst=10, logperiod=60.0, alarmonly=False, native=False):
+        # Log at most 'logburst' events of each PV in 'logperiod' seconds
+        self.logburst, self.logperiod = logburst, logperiod
+        # Subscribe for alarm state changes only (DBE_ALARM) instead of every value change
+        self.alarmonly = alarmonly
+        # Receive values in their native type instead of DBR_STRING.
+        # Values are formatted when a notification is rendered.
+        self.native = native
+
+    @classmethod
+    def fromconfig(cls, MS):
+        return cls(logburst=MS.getint('pvLogBurst', 10),
+                   logperiod=MS.getdouble('pvLogPeriod', 60.0),
+                   alarmonly=MS.get('monitorEvents', 'value')=='alarm',
+                   native=MS.getbool('nativeType', False))
+
+    def monitor_args(self, ca):
+        args = {'format':ca.FORMAT_TIME,
+                'count':1,
+                'notify_disconnect':True}
+        if not self.native:
+            args['datatype'] = ca.DBR_STRING
+        if self.alarmonly:
+            args['events'] = ca.DBE_ALARM
+        return args
+
+    def __eq__(self, other):
+        return vars(self)==vars(other)
+    def __ne__(self, other):
+        return not self==other
+
+_DEFAULTS = Options()
+
+class MetaFetcher(object):
+    """Fetch CA display meta-data (units, limits, ...) in the background.
+
+    Requests are gathered for 'delay' seconds and then fetched
+    with list caget() calls of up to 'batch' names.  Results are
+    cached for 'ttl' seconds, including across reconnects.
+    """
+    _default = None
+    def __init__(self, ttl=3600.0, delay=0.5, batch=1000, timeout=2.0):
+        import cothread
+        self.ttl, self.delay, self.batch, self.timeout = ttl, delay, batch, timeout
+        self._cache = {} # {name:(fetch time, meta)}
+        self._want = {} # {name:[callback]}
+        self._stop = False
+        self._wake = cothread.Event()
+        self.T = cothread.Spawn(self._run)
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def close(self):
+        self._stop = True
+        self._wake.Signal()
+        self.T.Wait()
+
+    def get(self, name, cb):
+        """Return meta-data for the named PV if cached, or None.
+        If missing or expired, a fetch is queued and cb(meta)
+        will be called when it completes.
+        """
+        E = self._cache.get(name)
+        if E is not None and time.time()-E[0] < self.ttl:
+            return E[1]
+        L = self._want.get(name)
+        if L is None:
+            self._want[name] = [cb]
+            self._wake.Signal()
+        elif cb not in L:
+            L.append(cb)
+        return E and E[1] # use expired entry while fetching
+
+    def cached(self, name):
+        """Return meta-data for the named PV if ever fetched, or None
+        """
+        E = self._cache.get(name)
+        return E and E[1]
+
+    def _run(self):
+        import cothread
+        ca = catools()
+        while not self._stop:
+            self._wake.Wait()
+            cothread.Sleep(self.delay)
+
+            while self._want and not self._stop:
+                names = list(itertools.islice(self._want, self.batch))
+                LOG.debug('Fetching metadata for %d PVs', len(names))
+                metas = ca.caget(names, format=ca.FORMAT_CTRL,
+                                 timeout=self.timeout, throw=False)
+                now = time.time()
+                for name, meta in itertools.izip(names, metas):
+                    cbs = self._want.pop(name)
+                    if not meta.ok:
+                        LOG.warning('Failed to fetch metadata for %s', name)
+                        continue
+                    self._cache[name] = (now, meta)
+                    for cb in cbs:
+                        try:
+                            cb(meta)
+                        except:
+                            LOG.exception('Error in metadata callback for %s', name)
+
+class SlidingCount(object):
+    """Number of events in the last 'window' seconds.
+
+    The window is divided into 'nbuckets' so that add() and
+    count() do not depend on the number of events in the window.
+    """
+    __slots__ = ('window', 'period', 'buckets', 'idx', 'T', 'total')
+    def __init__(self, window, nbuckets=10, now=None):
+        self.window, self.period = window, window/float(nbuckets)
+        self.buckets, self.idx, self.total = [0]*nbuckets, 0, 0
+        self.T = time.time() if now is None else now # start of current bucket
+
+    def add(self, now):
+        self.advance(now)
+        self.buckets[self.idx] += 1
+        self.total += 1
+        return self.total
+
+    def count(self, now):
+        self.advance(now)
+        return self.total
+
+    def advance(self, now):
+        steps = int((now-self.T)/self.period)
+        if steps<=0:
+            return
+        B = self.buckets
+        if steps>=len(B):
+            B[:] = [0]*len(B)
+            self.total = 0
+        else:
+            for _n in range(steps):
+                self.idx = (self.idx+1)%len(B)
+                self.total -= B[self.idx]
+                B[self.idx] = 0
+        self.T += steps*self.period
+
+class PV(object):
+    """One CA subscription.  Updates are classified once, and events
+    are routed to the NotifyFanout of each group listing the PV.
+    """
+    def __init__(self, pvname, conf, notify, subscribe=True, fetcher=None, opts=None):
+        self._name = pvname
+        self._opts = opts or _DEFAULTS
+        self._targets = [(conf, notify)] # [(PVNode, NotifyFanout)]
         self._prev, self._meta = None, None
-        self._sub = ca.camonitor(pvname, self._update,
-                                 datatype=ca.DBR_STRING,
-                                 format=ca.FORMAT_TIME,
-                                 count=1,
-                                 notify_disconnect=True)
+        self._seeded = False # _prev is from a checkpoint
+        self._fetcher = fetcher or MetaFetcher.default()
+        self._sub = None
+        self._code = state.DISCONN # severity, or DISCONN
+        self._flap = None # SlidingCount of transitions
+        self._flapT = None # Timer while flapping
+        self._nsupp = 0
+        self._logT, self._nlog = 0.0, 0 # start of log window, and events logged in it
+        state.INDEX.add(self)
+        _M_DISCONN.inc()
+        if subscribe:
+            ca = catools()
+            self._sub = ca.camonitor(pvname, self._update, **self._opts.monitor_args(ca))
+
+    @property
+    def _conf(self):
+        """The first group.  Its flap detection and alarminitial settings apply.
+        """
+        return self._targets[0][0]
+
+    @property
+    def _confs(self):
+        return [C for C, _N in self._targets]
+
+    def addtarget(self, conf, notify):
+        """Also route events to another group
+        """
+        self._targets.append((conf, notify))
+        state.INDEX.add(self, self._code, [conf])
+
+    def deltarget(self, group):
+        """Stop routing events to a group.  The last group is not removed.
+        Returns False if this PV should be closed instead.
+        """
+        if len(self._targets)==1:
+            return False
+        for i, (C, _N) in enumerate(self._targets):
+            if C.name==group:
+                state.INDEX.remove(self, self._code, [C])
+                del self._targets[i]
+                break
+        return True
+
+    def _send(self, data, reason, suppressed=0):
+        """Route an event to each group.
+        Returns the event, and False if any queue was full.
+        """
+        ok = True
+        for C, N in self._targets:
+            evt = util.AlarmEvent(data, self._meta, reason, C, self._fetcher.cached)
+            evt.suppressed = suppressed
+            ok &= N.add(evt)
+        return evt, ok
 
     def close(self):
-        self._sub.close()
+        if self._sub is not None:
+            self._sub.close()
+            self._sub = None
+            if self._prev is not None and self._prev.ok:
+                _M_CONN.dec()
+            else:
+                _M_DISCONN.dec()
+            state.INDEX.remove(self, self._code)
+        if self._flapT is not None:
+            self._flapT.cancel()
+            self._flapT = None
+            _M_FLAPPING.dec()
+
+    def _seed(self, data):
+        """Take the last value from before a restart (see checkpoint)
+        as the previous value.  Must be called before subscribing.
+        """
+        assert self._prev is None
+        self._prev, self._seeded = data, True
+        if data.ok:
+            _M_DISCONN.dec()
+            _M_CONN.inc()
+        code = data.severity if data.ok else state.DISCONN
+        if code!=self._code:
+            state.INDEX.move(self, self._code, code)
+            self._code = code
+
+    def _unseed(self):
+        """Forget a seeded value.  The PV is again treated
+        as never having connected.
+        """
+        P, self._prev, self._seeded = self._prev, None, False
+        if P.ok:
+            _M_CONN.dec()
+            _M_DISCONN.inc()
+        if self._code!=state.DISCONN:
+            state.INDEX.move(self, self._code, state.DISCONN)
+            self._code = state.DISCONN
 
     def _update(self, data):
         """Decide if an alarm is in effect and
         classify it
         """
-        P, self._prev = self._prev, data
+        P, self._prev, self._seeded = self._prev, data, False
+        _M_UPDATES.inc()
+        if _capture is not None:
+            _capture.record(data)
 
-        if data.update_count!=1:
-            self.notify.add(util.AlarmEvent(data, None, util.RES_LOST))
+        # a disconnected value (ca_nothing) has no severity
+        Psevr = self._code
+        code = data.severity if data.ok else state.DISCONN
+        if code!=self._code:
+            state.INDEX.move(self, self._code, code)
+            self._code = code
+
+        if data.ok != (P is not None and P.ok):
+            if data.ok:
+                _M_CONN.inc()
+                _M_DISCONN.dec()
+            else:
+                _M_CONN.dec()
+                _M_DISCONN.inc()
+
+        if getattr(data, 'update_count', 1)!=1:
+            _M_LOST.inc()
+            self._send(data, util.RES_LOST)
+
+        if data.ok and self._meta is None:
+            # never wait for CA display meta-data
+            self._meta = self._fetcher.get(data.name, self._setmeta)
 
         reason = None
         if P is None:
-            # Initial update
+            # Initial update.  A PV seeded from a checkpoint instead
+            # compares with its value from before the restart.
             if self._conf.oninitial:
                 if not data.ok:
                     reason = util.RES_DISCONN
-                if data.severity!=0:
+                elif data.severity!=0:
                     reason = util.RES_ALARM
-            return
 
-        if data.ok:
-            if self._meta is None:
-                from cothread import catools as ca
-                try:
-                    # Fetch CA display meta-data
-                    self._meta = ca.caget(data.name, format=ca.FORMAT_CTRL, timeout=2)
-                except:
-                    LOG.exception('Failed to fetch metadata for %s', data.name)
-
-            if P.severity and not data.severity:
+        elif data.ok:
+            if Psevr and not data.severity:
                 reason = util.RES_NORMAL
-            elif not P.severity and data.severity:
+            elif not Psevr and data.severity:
                 reason = util.RES_ALARM
-            elif P.severity < data.severity:
+            elif Psevr < data.severity:
                 reason = util.RES_INCREASE
-            elif P.severity > data.severity:
+            elif Psevr > data.severity:
                 reason = util.RES_DECREASE
         elif P.ok:
-            self._meta = None # will fetch meta-data again on reconnect
+            self._meta = None # will look up meta-data again on reconnect
             reason = util.RES_DISCONN
 
+        if reason is not None and self._conf.flaphigh:
+            reason = self._flapping(reason)
+
         if reason is not None:
-            evt = util.AlarmEvent(data, self._meta, reason, self._conf)
-            if not self._notify.add(evt):
-                LOG.error('Lost: %s', evt)
+            evt, ok = self._send(data, reason)
+            if not ok:
+                self._log(logging.ERROR, 'Lost: %s', evt)
             else:
-                LOG.info('event: %s', evt)
+                self._log(logging.INFO, 'event: %s', evt)
+
+    def _log(self, level, msg, evt):
+        """Log an event, unless this PV has already logged 'logburst'
+        in the current window.  The number skipped is logged when the
+        next window starts.
+        """
+        now, burst, period = time.time(), self._opts.logburst, self._opts.logperiod
+        if now-self._logT>=period:
+            if self._nlog>burst:
+                LOG.warning('%s: %d events not logged', self._name, self._nlog-burst)
+            self._logT, self._nlog = now, 0
+        self._nlog += 1
+        if self._nlog<=burst:
+            LOG.log(level, msg, evt)
+        elif self._nlog==burst+1:
+            LOG.warning('%s: more than %d events in %.0f sec.  Not logging further events',
+                        self._name, burst, period)
+
+    def _flapping(self, reason):
+        """Count a transition.  Returns the reason for the event
+        to be sent, or None to suppress it.
+        """
+        C, now = self._conf, time.time()
+        if self._flap is None or self._flap.window!=C.flapwindow:
+            self._flap = SlidingCount(C.flapwindow, now=now)
+        N = self._flap.add(now)
+        if self._flapT is not None:
+            self._nsupp += 1
+            _M_SUPPRESSED.inc()
+            return None
+        elif N>=C.flaphigh:
+            LOG.warning('%s is flapping. %d events in %.0f sec', self._name, N, C.flapwindow)
+            self._nsupp = 0
+            _M_FLAPPING.inc()
+            import cothread
+            self._flapT = cothread.Timer(self._flap.period, self._flapcheck, retrigger=True)
+            return util.RES_FLAP
+        return reason
+
+    def _flapcheck(self):
+        C = self._conf
+        if self._flapT is None or self._flap.count(time.time())>C.flaplow:
+            return
+        LOG.info('%s stopped flapping. %d events suppressed', self._name, self._nsupp)
+        self._flapT.cancel()
+        self._flapT = None
+        _M_FLAPPING.dec()
+        data = self._prev if self._prev is not None else util.DummyValue(self._name)
+        self._send(data, util.RES_FLAPEND, self._nsupp)
+
+    def _setmeta(self, meta):
+        if self._prev is not None and self._prev.ok:
+            self._meta = meta
+
+class Registry(object):
+    """One PV, and so one CA subscription, for each unique name
+    no matter how many groups list it.
+    """
+    def __init__(self, fetcher=None, opts=None):
+        self.fetcher = fetcher
+        self.opts = opts or Options() # shared by all PVs
+        self._pvs = {} # {pv name:PV}
+
+    def __len__(self):
+        return len(self._pvs)
+
+    def __getitem__(self, name):
+        return self._pvs[name]
+
+    def itervalues(self):
+        return self._pvs.itervalues()
+
+    def add(self, conf, notify, names):
+        """Add PVs to a group.  Returns the new PVs, which
+        must then be subscribed.
+        """
+        new = []
+        for name in names:
+            P = self._pvs.get(name)
+            if P is None:
+                P = self._pvs[name] = PV(name, conf, notify, subscribe=False, fetcher=self.fetcher,
+                                         opts=self.opts)
+                new.append(P)
+            else:
+                P.addtarget(conf, notify)
+        return new
+
+    def remove(self, group, names):
+        """Remove PVs from a group.  PVs in no other group are closed.
+        Returns the number closed.
+        """
+        N = 0
+        for name in names:
+            P = self._pvs[name]
+            if not P.deltarget(group):
+                del self._pvs[name]
+                P.close()
+                N += 1
+        return N
+
+    def configure(self, opts):
+        """Apply new Options.  If the event mask or type changed,
+        subscribed PVs are subscribed again.
+        Returns True if PVs were subscribed again.
+        """
+        resub = (opts.alarmonly, opts.native)!=(self.opts.alarmonly, self.opts.native)
+        self.opts.__dict__.update(vars(opts))
+        pvs = [P for P in self._pvs.itervalues() if P._sub is not None]
+        if not resub or not pvs:
+            return False
+        for P in pvs:
+            P._sub.close()
+        subscribe(pvs, self.opts)
+        return True
+
+    def close(self):
+        for P in self._pvs.itervalues():
+            P.close()
+        self._pvs.clear()
+
+def subscribe(pvs, opts=None):
+    """Start monitors for PVs created with subscribe=False
+    using one camonitor() call for the whole list.
+    """
+    ca = catools()
+    pvs = list(pvs)
+    def update(data, idx):
+        pvs[idx]._update(data)
+    subs = ca.camonitor([P._name for P in pvs], update, **(opts or _DEFAULTS).monitor_args(ca))
+    for P, S in zip(pvs, subs):
+        P._sub = S
+
+def waitconnect(pvs, timeout, settle=1.0, progress=None):
+    """Wait until all PVs have connected, or until the number
+    connected has not increased for 'settle' seconds, or for
+    at most 'timeout' seconds.  Progress messages are passed
+    to progress(msg).
+
+    Returns the number of PVs connected.
+    """
+    import cothread
+    T0 = time.time()
+    Tlast, Nlast, N, Tmsg = T0, 0, 0, T0-1.0
+    while True:
+        N = sum([1 for P in pvs if P._prev is not None and not P._seeded])
+        now = time.time()
+        if N>Nlast:
+            Tlast, Nlast = now, N
+            if progress and now-Tmsg>=1.0:
+                Tmsg = now
+                progress('Connected %d of %d PVs'%(N, len(pvs)))
+
+        if N==len(pvs) or now-T0>=timeout or (N and now-Tlast>=settle):
+            break
+        cothread.Sleep(min(0.25, settle))
+
+    LOG.info('%d of %d PVs connected after %.1f sec', N, len(pvs), time.time()-T0)
+    return N
 
 class PrintNotify(object):
     def add(self, evt):
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os
+
+class CachingLoader(object):
+    """Drop-in for django.template.loader.render_to_string()
+
+    Templates are found and compiled through Django's configured
+    loaders, and the compiled Template is kept.  It is re-compiled
+    when the modification time of the template file changes.
+    Templates which it includes or extends are not checked.
+
+    Only compiled templates are cached.  Output is not, since any
+    context variable may be used by an included template or a tag.
+    """
+    def __init__(self):
+        self._compiled = {} # {name:(path, mtime, Template)}
+
+    def get_template(self, name):
+        E = self._compiled.get(name)
+        if E is not None:
+            path, mtime, tmpl = E
+            if path is None or _mtime(path)==mtime:
+                return tmpl
+        from django.template.loader import get_template
+        LOG.debug('Compiling template %s', name)
+        tmpl = get_template(name)
+        # django>=1.8 wraps the Template of the engine
+        tmpl = getattr(tmpl, 'template', tmpl)
+        origin = getattr(tmpl, 'origin', None)
+        path = getattr(origin, 'name', None)
+        if path is not None and not os.path.isfile(path):
+            path = None # not from a file.  Never re-compiled
+        self._compiled[name] = (path, path and _mtime(path), tmpl)
+        return tmpl
+
+    def render_to_string(self, name, ctxt):
+        from django.template import Context
+        return self.get_template(name).render(Context(dict(ctxt))) # tags may assign to the context
+
+    def clear(self):
+        self._compiled.clear()
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+# shared by all Notifiers
+loader = CachingLoader()
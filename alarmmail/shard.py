@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os, signal, struct, marshal, zlib, errno, time
+
+from . import util, state
+from .checkpoint import SavedValue
+
+# Workers send frames of _FRAME length followed by a marshal'd list of records
+#   ('E', AlarmEvent.totuple())
+#   ('S', group, pv name, code, ok, severity, status, timestamp, value)  PV state changed
+#   ('R', group, pv name)  PV removed
+#   ('D',)  initial connection complete
+#   ('X', nupdates, busy seconds)  statistics (benchmark)
+_FRAME = struct.Struct('!I')
+
+def partition(C, n):
+    """Split the PVs of all groups between n workers.
+    A PV name always goes to the same worker.
+
+    Returns [{group name:[pv name]}] with one entry for each worker
+    """
+    parts = [{} for _n in range(n)]
+    for G, node in C['pv'].iteritems():
+        for name in node.pvs:
+            parts[zlib.crc32(name)%n].setdefault(G, []).append(name)
+    return parts
+
+class Worker(object):
+    def __init__(self, idx, pid, fd):
+        self.idx, self.pid, self.fd = idx, pid, fd
+
+def fork(C, n, target=None):
+    """Start n worker processes.  Must be called before any other
+    cothreads are started.
+
+    Returns [Worker]
+    """
+    target = target or runworker
+    workers = []
+    for idx, part in enumerate(partition(C, n)):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid==0:
+            # worker
+            os.close(rfd)
+            for W in workers:
+                os.close(W.fd)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            _afterfork()
+            code = 1
+            try:
+                target(C, idx, part, wfd)
+                code = 0
+            except:
+                LOG.exception('Worker %d failed', idx)
+            finally:
+                os._exit(code)
+        os.close(wfd)
+        LOG.info('Started worker %d (pid %d) with %d PVs', idx, pid, sum(map(len, part.itervalues())))
+        workers.append(Worker(idx, pid, rfd))
+    return workers
+
+def _afterfork():
+    """cothread creates the pipe used by Callback() when imported.
+    Give the worker its own so that it does not consume wakeups
+    meant for the parent.  Also restart background log writers.
+    """
+    import cothread
+    CB = cothread.cothread.Callback
+    rfd, wfd = os.pipe()
+    os.dup2(rfd, CB.wait)
+    os.dup2(wfd, CB.signal)
+    os.close(rfd)
+    os.close(wfd)
+    for H in logging.getLogger().handlers:
+        if hasattr(H, 'afterfork'):
+            H.afterfork()
+
+class Pipe(object):
+    """Worker side.  Records are buffered and written every
+    'period' seconds, or when 'batch' records are waiting.
+    """
+    def __init__(self, fd, period=0.02, batch=1000):
+        import cothread
+        self._fd, self.period, self.batch = fd, period, batch
+        self._buf = []
+        self._T = cothread.Spawn(self._run)
+
+    def send(self, rec):
+        self._buf.append(rec)
+        if len(self._buf)>=self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self._buf:
+            return
+        buf, self._buf = self._buf, []
+        data = marshal.dumps(buf)
+        data = _FRAME.pack(len(data))+data
+        try:
+            while data:
+                data = data[os.write(self._fd, data):]
+        except OSError as e:
+            if e.errno==errno.EPIPE:
+                LOG.error('Aggregator has exited')
+                os._exit(1)
+            raise
+
+    def _run(self):
+        import cothread
+        while True:
+            cothread.Sleep(self.period)
+            self.flush()
+
+class EventSink(object):
+    """Worker side stand in for NotifyFanout
+    """
+    def __init__(self, pipe):
+        self._pipe = pipe
+    def add(self, evt):
+        self._pipe.send(('E', evt.totuple()))
+        return True
+
+class ForwardIndex(object):
+    """Worker side stand in for state.INDEX which passes
+    PV state changes to the aggregator.
+    """
+    def __init__(self, pipe):
+        self._pipe = pipe
+    def add(self, P, code=state.DISCONN, confs=None):
+        self._state(P, code, confs or P._confs)
+    def move(self, P, old, new):
+        self._state(P, new, P._confs)
+    def _state(self, P, code, confs):
+        V = P._prev
+        if V is not None and V.ok:
+            rec = (P._name, code, True, V.severity, V.status, V.timestamp, util.valuestr(V, P._meta))
+        else:
+            rec = (P._name, code, False, 0, 0, 0.0, '')
+        for C in confs:
+            self._pipe.send(('S', C.name)+rec)
+    def remove(self, P, code, confs=None):
+        for C in confs or P._confs:
+            self._pipe.send(('R', C.name, P._name))
+
+def runworker(C, idx, part, wfd, run=None):
+    """Worker process.  Monitor and classify the PVs in part {group:[pv name]}.
+    After the initial connection, run(pvs, pipe) is called if given.
+    """
+    import cothread
+    from . import pv, checkpoint
+    from .main import initialwait
+
+    MS = C['main']
+    pipe = Pipe(wfd)
+    state.INDEX = ForwardIndex(pipe)
+    sink = EventSink(pipe)
+    if MS.get('captureDir'):
+        from . import capture
+        pv._capture = capture.CaptureLog(os.path.join(MS.get('captureDir'), 'worker%d'%idx),
+                                         filesize=MS.getint('captureSize', 64)*2**20,
+                                         nfiles=MS.getint('captureFiles', 4))
+
+    registry = pv.Registry(pv.MetaFetcher(ttl=MS.getdouble('metaTTL', 3600.0)), pv.Options.fromconfig(MS))
+    pvs = []
+    for G in sorted(part):
+        pvs.extend(registry.add(C['pv'][G], sink, part[G]))
+
+    if MS.get('checkpoint'):
+        checkpoint.seed(pvs, checkpoint.load(MS.get('checkpoint')))
+    pv.subscribe(pvs, registry.opts)
+    initialwait(pvs, MS)
+    pipe.send(('D',))
+    pipe.flush()
+
+    if run:
+        run(pvs, pipe)
+    cothread.WaitForQuit()
+
+class RemotePV(object):
+    """Aggregator side copy of the state of a PV in a worker.
+    Has the attributes of pv.PV used by state.INDEX and checkpoint.
+    """
+    __slots__ = ('_name', '_conf', '_code', '_prev', '_meta')
+    def __init__(self, name, conf):
+        self._name, self._conf, self._code, self._prev = name, conf, None, None
+        self._meta = None # values are formatted by the worker
+    @property
+    def _confs(self):
+        return (self._conf,)
+
+class Aggregator(object):
+    """Receive records from workers.  Events are passed to the
+    NotifyFanout of their PV group, and PV state to state.INDEX.
+    """
+    def __init__(self, workers, C, fanouts):
+        import cothread
+        self.C, self.fanouts = C, fanouts
+        self.pvs = {} # {(group, pv name):RemotePV}
+        self.nready, self.nworkers = 0, len(workers)
+        self.ready = cothread.Event(auto_reset=False)
+        self.stats = []
+        self._closing = False
+        self._tasks = [cothread.Spawn(self._run, W) for W in workers]
+
+    def _run(self, W):
+        from cothread.coselect import select, SelectError
+        buf = ''
+        while True:
+            try:
+                select([W.fd], [], [])
+                data = os.read(W.fd, 2**16)
+            except (SelectError, OSError):
+                data = ''
+            if not data:
+                if self._closing:
+                    LOG.info('Worker %d (pid %d) stopped', W.idx, W.pid)
+                else:
+                    LOG.error('Worker %d (pid %d) has exited', W.idx, W.pid)
+                os.close(W.fd)
+                return
+            buf += data
+            while len(buf)>=_FRAME.size:
+                N, = _FRAME.unpack_from(buf)
+                if len(buf)<_FRAME.size+N:
+                    break
+                recs = marshal.loads(buf[_FRAME.size:_FRAME.size+N])
+                buf = buf[_FRAME.size+N:]
+                try:
+                    self.dispatch(recs)
+                except:
+                    LOG.exception('Error handling records from worker %d', W.idx)
+
+    def dispatch(self, recs):
+        confs, fanouts, index = self.C['pv'], self.fanouts, state.INDEX
+        for R in recs:
+            kind = R[0]
+            if kind=='E':
+                evt = util.AlarmEvent.fromtuple(R[1], confs)
+                fanouts[evt.conf.name].add(evt)
+            elif kind=='S':
+                _k, G, name, code, ok, sevr, stat, T, val = R
+                P = self.pvs.get((G, name))
+                if P is None:
+                    P = self.pvs[(G, name)] = RemotePV(name, confs[G])
+                    P._code = code
+                    index.add(P, code)
+                elif code!=P._code:
+                    index.move(P, P._code, code)
+                    P._code = code
+                P._prev = SavedValue(name, ok, sevr, stat, T, val)
+            elif kind=='R':
+                P = self.pvs.pop((R[1], R[2]), None)
+                if P is not None:
+                    index.remove(P, P._code)
+            elif kind=='D':
+                self.nready += 1
+                if self.nready==self.nworkers:
+                    self.ready.Signal()
+            elif kind=='X':
+                self.stats.append(R[1:])
+
+    def allpvs(self):
+        return self.pvs.itervalues()
+
+    def close(self):
+        """Workers are about to be stopped
+        """
+        self._closing = True
+
+def stop(workers, timeout=5.0):
+    """Terminate worker processes
+    """
+    for W in workers:
+        try:
+            os.kill(W.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    T0 = time.time()
+    for W in workers:
+        while True:
+            try:
+                pid, _sts = os.waitpid(W.pid, os.WNOHANG)
+            except OSError:
+                break
+            if pid or time.time()-T0>timeout:
+                break
+            time.sleep(0.05)
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import time, random, re, resource, threading
+
+from . import config, util, pv
+
+class SimValue(str):
+    """Stand-in for a cothread.catools augmented value (DBR_STRING, FORMAT_TIME)
+    """
+    ok = True
+    severity, status = 0, 0
+    timestamp = 0.0
+    update_count = 1
+    units = ''
+    def __new__(cls, value, name, **kws):
+        self = str.__new__(cls, value)
+        self.name = name
+        self.__dict__.update(kws)
+        return self
+
+class SimNumber(float):
+    """Native type (DBR_DOUBLE) counterpart of SimValue
+    """
+    ok = True
+    severity, status = 0, 0
+    timestamp = 0.0
+    update_count = 1
+    units = ''
+    def __new__(cls, value, name, **kws):
+        self = float.__new__(cls, value)
+        self.name = name
+        self.__dict__.update(kws)
+        return self
+
+class SimDisconnect(str):
+    """Stand-in for cothread.catools.ca_nothing, sent when a PV disconnects.
+    Like ca_nothing it has no severity.
+    """
+    ok = False
+    def __new__(cls, name):
+        self = str.__new__(cls, 'Disconnected')
+        self.name = name
+        return self
+
+class _Sub(object):
+    def __init__(self, fake, name, cb, events):
+        self._fake, self.name, self._cb, self.events = fake, name, cb, events
+    def close(self):
+        self._fake._subs[self.name].remove(self)
+
+class FakeCA(object):
+    """Replacement for cothread.catools which delivers updates
+    passed to post() instead of from the network.
+
+    As with a real IOC, new monitors soon receive the current value,
+    and monitors without DBE_VALUE only receive changes of alarm state.
+    PVs named in 'offline' never connect.
+    """
+    DBR_STRING, FORMAT_TIME, FORMAT_CTRL = 0, 1, 2
+    DBE_VALUE, DBE_LOG, DBE_ALARM = 1, 2, 4
+
+    def __init__(self, units='arb'):
+        self._subs = {} # {name:[_Sub]}
+        self._last = {} # {name:SimValue}
+        self.units = units
+        self.offline = set()
+
+    def camonitor(self, names, callback, events=DBE_VALUE, **kws):
+        if isinstance(names, str):
+            S = self.camonitor([names], lambda V, i: callback(V), events=events)
+            return S[0]
+        ret = []
+        for i, name in enumerate(names):
+            S = _Sub(self, name, lambda V, i=i: callback(V, i), events)
+            self._subs.setdefault(name, []).append(S)
+            ret.append(S)
+        import cothread
+        cothread.Spawn(self._connect, ret)
+        return ret
+
+    def _connect(self, subs):
+        for S in subs:
+            if S.name in self.offline:
+                continue
+            V = self._last.get(S.name)
+            if V is None:
+                V = self._last[S.name] = SimValue('0', S.name, timestamp=time.time())
+            S._cb(V)
+
+    def caget(self, names, **kws):
+        return [SimValue('', name, units=self.units) for name in names]
+
+    def post(self, value):
+        """Deliver an update to all monitors of value.name
+        """
+        P = self._last.get(value.name)
+        alarm = (P is None or not P.ok or not value.ok
+                 or P.severity!=value.severity or P.status!=value.status)
+        self._last[value.name] = value
+        for S in self._subs.get(value.name, ()):
+            if alarm or S.events&self.DBE_VALUE:
+                S._cb(value)
+
+    def disconnect(self, name):
+        """Deliver a disconnect to all monitors of the named PV
+        """
+        self.post(SimDisconnect(name))
+
+def install(fake):
+    """Use 'fake' in place of cothread.catools for new PVs
+    """
+    pv._ca = fake
+
+class SinkSMTP(object):
+    """Stand-in for smtplib.SMTP which accepts and counts messages.
+    End-to-end latency is found through the X-Alarmmail-Bench header.
+    """
+    _batch = re.compile(r'^X-Alarmmail-Bench: (\d+)$', re.M)
+
+    def __init__(self, bench):
+        self._bench = bench
+    def __call__(self, *args, **kws):
+        return self # acts as its own connection factory
+    def sendmail(self, mfrom, mto, msg):
+        now = time.time()
+        M = self._batch.search(msg)
+        if M:
+            self._bench.delivered(int(M.group(1)), now)
+        return {}
+    def noop(self):
+        return (250, 'OK')
+    def quit(self):
+        pass
+    def close(self):
+        pass
+
+def synthetic(names, rate, duration, flap=0.5, noise=0.0):
+    """Yield (time offset, name, severity) for 'rate' transitions per second
+    on randomly chosen PVs.  'flap' is the fraction of transitions which
+    go to the PV most recently changed.  A further 'noise' updates per
+    second change only the value of a random PV.
+    """
+    sevr = dict.fromkeys(names, 0)
+    last = names[0]
+    total = rate+noise
+    for n in xrange(int(total*duration)):
+        if random.random()*total<noise:
+            name = random.choice(names)
+            yield n/total, name, sevr[name]
+            continue
+        name = last if random.random()<flap else random.choice(names)
+        S = sevr[name] = (sevr[name]+1)%3
+        last = name
+        yield n/total, name, S
+
+def recorded(fname):
+    """Yield (time offset, name, severity) from a text file
+    with lines of: <time offset> <PV name> <severity>
+    """
+    with open(fname, 'r') as FP:
+        for line in FP:
+            line = line.strip()
+            if not line or line[0]=='#':
+                continue
+            T, name, S = line.split()
+            yield float(T), name, int(S)
+
+class Benchmark(object):
+    def __init__(self, opts):
+        self.opts = opts
+        self.fake = FakeCA()
+        self.pending = {} # {batch id:[(rxtimestamp, severity)]}
+        self.latency = [] # [(seconds, severity)]
+        self.nmajor = 0 # updates to Major or worse
+        self.nmails = 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def delivered(self, batch, now):
+        with self._lock:
+            self.nmails += 1
+            self.latency.extend([(now-T, S) for T, S in self.pending.pop(batch, ())])
+
+    def config(self, names):
+        opts = self.opts
+        # each PV is in 'overlap' consecutive groups
+        groups = [[] for i in range(opts.groups)]
+        for i, name in enumerate(names):
+            for j in range(min(opts.overlap, opts.groups)):
+                groups[(i+j)%opts.groups].append(name)
+        pvnodes = dict([('grp%d'%i, config.PVNode(config.SectionProxy.fromArgs('grp%d'%i, pvs=' '.join(G))))
+                        for i,G in enumerate(groups) if G])
+        dests = {}
+        for i in range(opts.dests):
+            # each destination gets half of the groups
+            G = sorted(pvnodes)[i%2::2] or sorted(pvnodes)
+            dests['dest%d'%i] = config.DestNode(config.SectionProxy.fromArgs('dest%d'%i,
+                    to='dest%d@bench.invalid'%i, groups=' '.join(G),
+                    delay=str(opts.delay), holdoff=str(opts.holdoff),
+                    queueSize=str(opts.queue_size), coalesce=str(opts.coalesce),
+                    adaptive=str(opts.adaptive), minDelay=str(opts.min_delay), minHoldoff=str(opts.min_holdoff),
+                    lanes='urgent:%d'%opts.urgent if opts.urgent else '',
+                    urgentDelay=str(opts.urgent_delay), urgentHoldoff=str(opts.urgent_holdoff)))
+        return {'main':config.SectionProxy.fromArgs('main', initialwait='30', initialsettle='5',
+                                                    monitorEvents='alarm' if opts.alarm_only else 'value',
+                                                    nativeType=str(opts.native)),
+                'mail':config.SectionProxy.fromArgs('mail', delay=str(opts.delay), holdoff=str(opts.holdoff),
+                                                    adaptive=str(opts.adaptive), minDelay=str(opts.min_delay),
+                                                    minHoldoff=str(opts.min_holdoff),
+                                                    queueSize='100000', concurrency='1'),
+                'pv':pvnodes,
+                'dest':dests}
+
+    def _instrument(self, D):
+        """Tag each mail with the reception times of the events it reports
+        """
+        current = []
+        server_add = D.mailer.add
+        def add(evt, urgent=False):
+            mfrom, mto, msg = evt
+            with self._lock:
+                batch, self._next = self._next, self._next+1
+                self.pending[batch] = current[0]
+            msg['X-Alarmmail-Bench'] = str(batch)
+            return server_add(evt, urgent)
+        D.mailer.add = add
+        D.mailer._transport = SinkSMTP(self)
+
+        for N in D.notifiers.itervalues():
+            def process(evts, overflow, _process=N.process, **extra):
+                current[:] = [[(E.rxtimestamp, E.sevr) for E in evts]]
+                _process(evts, overflow, **extra)
+            N.process = process
+
+    def names(self):
+        opts = self.opts
+        if opts.replay:
+            from . import capture
+            return sorted(set([V.name for _T, V in capture.replay(opts.replay)]))
+        elif opts.stream:
+            return sorted(set([name for _T, name, _S in recorded(opts.stream)]))
+        else:
+            return ['sim:%d'%i for i in range(opts.pvs)]
+
+    def stream(self, names, share=1.0):
+        """Yield (time offset, value) for updates to the named PVs.
+        'share' is the fraction of the synthetic rate to generate.
+        """
+        opts = self.opts
+        if opts.replay:
+            from . import capture
+            names = set(names)
+            return ((T, V) for T, V in capture.replay(opts.replay, opts.speed) if V.name in names)
+        elif opts.stream:
+            names = set(names)
+            trans = [E for E in recorded(opts.stream) if E[1] in names]
+        else:
+            trans = synthetic(names, opts.rate*share, opts.duration, opts.flap, opts.noise*share)
+        if opts.native:
+            return ((T, SimNumber(random.random()+S, name, severity=S, status=S and 3))
+                    for T, name, S in trans)
+        return ((T, SimValue(str(S), name, severity=S, status=S and 3))
+                for T, name, S in trans)
+
+    def pump(self, stream):
+        """Post updates at the times given.  Returns (number, busy time)
+        """
+        import cothread
+        nupdate, busy = 0, 0.0
+        T0 = time.time()
+        for T, V in stream:
+            now = time.time()
+            if T0+T > now:
+                cothread.Sleep(T0+T-now)
+            T1 = time.time()
+            if not self.opts.replay:
+                V.timestamp = T1
+            self.fake.post(V)
+            busy += time.time()-T1
+            nupdate += 1
+            if V.ok and V.severity>=2:
+                self.nmajor += 1
+        return nupdate, busy
+
+    def worker(self, C, idx, part, wfd):
+        """Runs in each worker process with --workers
+        """
+        from . import shard
+        install(self.fake)
+        def run(pvs, pipe):
+            names = [P._name for P in pvs]
+            nupdate, busy = self.pump(self.stream(names, 1.0/self.opts.workers))
+            pipe.send(('X', nupdate, busy))
+            pipe.flush()
+        shard.runworker(C, idx, part, wfd, run=run)
+
+    def run(self):
+        import cothread
+        from cothread.coselect import select_hook
+        from .main import AlarmDaemon
+        opts = self.opts
+
+        names = self.names()
+        C = self.config(names)
+        workers = None
+        if opts.workers:
+            from . import shard
+            workers = shard.fork(C, opts.workers, target=self.worker)
+        select_hook()
+        util.djangosetup(opts)
+
+        install(self.fake)
+        D = AlarmDaemon(C, workers)
+        D.start(_Quiet())
+        self._instrument(D)
+
+        print 'Simulating %d PVs in %d groups, %d destinations, %d workers'%(len(names), len(C['pv']),
+                                                                              len(D.notifiers), opts.workers)
+        T0, N0 = time.time(), pv._M_UPDATES.value
+        if workers:
+            while len(D.agg.stats)<len(workers):
+                cothread.Sleep(0.1)
+            nupdate = sum([N for N, _B in D.agg.stats])
+            busy = max([B for _N, B in D.agg.stats])
+        else:
+            nupdate, busy = self.pump(self.stream(names))
+        Tgen, ncb = time.time()-T0, pv._M_UPDATES.value-N0
+        nchan = sum(map(len, self.fake._subs.itervalues()))
+
+        # flush everything
+        D.close()
+        Tall = time.time()-T0
+
+        def pct(L, p):
+            return L[min(len(L)-1, int(p*len(L)))] if L else float('nan')
+        def pcts(L):
+            return 'p50 %.3f  p90 %.3f  p99 %.3f  max %.3f sec'%(pct(L, 0.5), pct(L, 0.9), pct(L, 0.99), pct(L, 1.0))
+        L = sorted([T for T, _S in self.latency])
+        # Major, Invalid, and disconnected
+        H = sorted([T for T, S in self.latency if S>=2 and S<=4])
+        print 'Updates:    %d in %.2f sec (%.0f/sec offered)'%(nupdate, Tgen, nupdate/max(Tgen, 1e-6))
+        if not workers:
+            print 'Callbacks:  %d'%ncb
+            print 'Channels:   %d'%nchan
+        print 'Ingest:     %.1f usec per update (%.0f updates/sec max)'%(1e6*busy/max(nupdate,1), nupdate/max(busy, 1e-9))
+        print 'Delivered:  %d events in %d mails, %.2f sec total'%(len(L), self.nmails, Tall)
+        print 'Latency:    %s'%pcts(L)
+        if not workers:
+            print 'Major+:     %d events delivered (%d updates)'%(len(H), self.nmajor)
+        print 'Latency:    %s (Major+)'%pcts(H)
+        print 'Peak RSS:   %.1f MB'%(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.),
+        if workers:
+            print '(largest worker %.1f MB)'%(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.)
+        else:
+            print
+
+class _Quiet(object):
+    def msg(self, msg):
+        LOG.info('%s', msg)
+
+def benchmark(opts, C):
+    Benchmark(opts).run()
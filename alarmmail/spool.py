@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import os, os.path, struct, marshal
+
+_HDR = struct.Struct('!I')
+
+class MailSpool(object):
+    """Append-only on-disk queue of outgoing mail.
+
+    Messages are appended to numbered segment files as length prefixed
+    records and never re-written.  A separate cursor file records
+    how far delivery has progressed.  Segments which have been
+    completely delivered are deleted.
+
+    Appends are flushed to the OS immediately.  sync() must be called
+    to fsync(), which is done once per batch by the sender.
+    """
+    def __init__(self, dirname, segsize=16*2**20):
+        self.dir, self.segsize = dirname, segsize
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        segs = sorted([int(F[:-6]) for F in os.listdir(dirname) if F.endswith('.spool')])
+        self._cursor = self._readcursor(segs[0] if segs else 0)
+
+        for S in segs:
+            if S < self._cursor[0]:
+                self._unlink(S)
+        segs = [S for S in segs if S >= self._cursor[0]] or [self._cursor[0]]
+
+        # count undelivered messages, and drop any partial record
+        # left at the end of the last segment.
+        self.pending = 0
+        for S in segs:
+            cnt, end = self._scan(S, self._cursor[1] if S==self._cursor[0] else 0)
+            self.pending += cnt
+        self._wseg = segs[-1]
+        self._W = self._writer(self._wseg)
+        if self._W.tell()!=end:
+            LOG.warning('Truncating partial record in spool segment %d', self._wseg)
+            self._W.truncate(end)
+            self._W.seek(end)
+
+        self._R, self._rseg = None, None
+        if self.pending:
+            LOG.info('Spool %s has %d undelivered mails', dirname, self.pending)
+
+    def close(self):
+        self.sync()
+        self._W.close()
+        if self._R:
+            self._R.close()
+
+    def sync(self):
+        self._W.flush()
+        os.fsync(self._W.fileno())
+
+    def append(self, mfrom, mto, msg):
+        """Add a message (as a string) to the end of the spool
+        """
+        data = marshal.dumps((mfrom, list(mto), msg))
+        self._W.write(_HDR.pack(len(data)))
+        self._W.write(data)
+        self._W.flush()
+        self.pending += 1
+        if self._W.tell() >= self.segsize:
+            self.sync()
+            self._W.close()
+            self._wseg += 1
+            self._W = self._writer(self._wseg)
+
+    def peek(self, limit):
+        """Read up to 'limit' messages from the front of the spool without removing them.
+
+        Returns a list of ((mfrom, mto, msg), position) where position
+        may be passed to commit() once delivery has completed.
+        """
+        seg, off = self._cursor
+        ret = []
+        while len(ret)<limit and len(ret)<self.pending:
+            R = self._reader(seg)
+            R.seek(off)
+            hdr = R.read(_HDR.size)
+            if len(hdr)<_HDR.size:
+                if seg>=self._wseg:
+                    break
+                # end of segment, continue with the next
+                seg, off = seg+1, 0
+                continue
+            data = R.read(_HDR.unpack(hdr)[0])
+            off = R.tell()
+            ret.append((marshal.loads(data), (seg, off, len(ret)+1)))
+        return ret
+
+    def commit(self, pos):
+        """Remove messages up to and including the one at 'pos' (from peek())
+        """
+        seg, off, cnt = pos
+        old = self._cursor[0]
+        self._cursor = (seg, off)
+        self.pending -= cnt
+        self._writecursor()
+        for S in range(old, seg):
+            if S==self._rseg:
+                self._R.close()
+                self._R, self._rseg = None, None
+            self._unlink(S)
+
+    def _writer(self, seg):
+        FP = open(self._segname(seg), 'ab')
+        FP.seek(0, 2)
+        return FP
+
+    def _reader(self, seg):
+        if self._rseg!=seg:
+            if self._R:
+                self._R.close()
+            self._W.flush()
+            self._R, self._rseg = open(self._segname(seg), 'rb'), seg
+        return self._R
+
+    def _scan(self, seg, off):
+        """Count complete records in a segment starting from offset.
+        Returns (count, offset of end of last complete record)
+        """
+        cnt = 0
+        try:
+            FP = open(self._segname(seg), 'rb')
+        except IOError:
+            return 0, 0
+        with FP:
+            FP.seek(0, 2)
+            size = FP.tell()
+            while off+_HDR.size <= size:
+                FP.seek(off)
+                L = _HDR.unpack(FP.read(_HDR.size))[0]
+                if off+_HDR.size+L > size:
+                    break
+                off += _HDR.size+L
+                cnt += 1
+        return cnt, off
+
+    def _segname(self, seg):
+        return os.path.join(self.dir, '%08d.spool'%seg)
+
+    def _unlink(self, seg):
+        try:
+            os.unlink(self._segname(seg))
+        except OSError:
+            pass
+
+    def _readcursor(self, default):
+        try:
+            with open(os.path.join(self.dir, 'cursor'), 'r') as FP:
+                seg, off = FP.read().split()
+                return int(seg), int(off)
+        except (IOError, ValueError):
+            return default, 0
+
+    def _writecursor(self):
+        fname = os.path.join(self.dir, 'cursor')
+        with open(fname+'.tmp', 'w') as FP:
+            FP.write('%d %d\n'%self._cursor)
+            FP.flush()
+            os.fsync(FP.fileno())
+        os.rename(fname+'.tmp', fname)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+"""
+
+import logging
+LOG = logging.getLogger(__name__)
+
+import json, time
+
+from . import util
+
+DISCONN = 4 # severity code used for disconnected PVs
+
+class AlarmIndex(object):
+    """Current alarm state of all PVs, by group and severity.
+
+    PVs move between severities with move().  Counts are kept per
+    group and severity, and only PVs which are not 'No Alarm' are
+    indexed by name, so queries do not visit every PV.
+
+    A PV is counted in each of its groups (P._confs) unless
+    add() or remove() are given a list of group configurations.
+    """
+    def __init__(self):
+        self._counts = {} # {group:[count per severity 0-4]}
+        self._active = {} # {group:{pv name:PV}} for severity!=0
+        self._nodes = {}  # {group:PVNode}
+
+    def add(self, P, code=DISCONN, confs=None):
+        for node in confs or P._confs:
+            G = node.name
+            C = self._counts.get(G)
+            if C is None:
+                C = self._counts[G] = [0]*(DISCONN+1)
+                self._active[G] = {}
+                self._nodes[G] = node
+            C[code] += 1
+            if code:
+                self._active[G][P._name] = P
+
+    def remove(self, P, code, confs=None):
+        for node in confs or P._confs:
+            G = node.name
+            C = self._counts[G]
+            C[code] -= 1
+            self._active[G].pop(P._name, None)
+            if not any(C):
+                del self._counts[G]
+                del self._active[G]
+                del self._nodes[G]
+
+    def move(self, P, old, new):
+        """Called from PV._update() when the severity changes
+        """
+        for node in P._confs:
+            G = node.name
+            C = self._counts[G]
+            C[old] -= 1
+            C[new] += 1
+            if not new:
+                del self._active[G][P._name]
+            elif not old:
+                self._active[G][P._name] = P
+
+    def node(self, group):
+        """Configuration (PVNode) of a group
+        """
+        return self._nodes[group]
+
+    def alarmed(self, group):
+        """PVs of a group which are in alarm or disconnected
+        """
+        return self._active.get(group, {}).values()
+
+    def counts(self, group=None):
+        """Returns {group:{severity name:count}}
+        """
+        groups = [group] if group else sorted(self._counts)
+        return dict([(G, dict([(util.SEVR(S).strip(), N)
+                               for S, N in enumerate(self._counts.get(G, [0]*(DISCONN+1)))]))
+                     for G in groups])
+
+    def active(self, group=None, minsevr=1):
+        """Returns a list of PVs in alarm with at least minsevr,
+        most severe first.
+        """
+        groups = [group] if group else sorted(self._active)
+        ret = []
+        for G in groups:
+            for name, P in self._active.get(G, {}).iteritems():
+                if P._code>=minsevr:
+                    V = P._prev
+                    ok = V is not None and V.ok
+                    ret.append({'name':name,
+                                'group':G,
+                                'severity':util.SEVR(P._code).strip(),
+                                'sevr':P._code,
+                                'status':V.status if ok else 0,
+                                'value':util.valuestr(V, P._meta) if ok else None,
+                                'timestamp':V.timestamp if ok else None,
+                                })
+        ret.sort(key=lambda E:(-E['sevr'], E['group'], E['name']))
+        return ret
+
+INDEX = AlarmIndex()
+
+def routes(index=INDEX):
+    """HTTP handlers for metrics.serve()
+    """
+    def alarms(query):
+        try:
+            minsevr = int(query.get('min', ['1'])[0])
+        except ValueError:
+            minsevr = 1
+        group = query.get('group', [None])[0]
+        return _json({'time':time.time(),
+                      'counts':index.counts(group),
+                      'alarms':index.active(group, minsevr)})
+    def counts(query):
+        group = query.get('group', [None])[0]
+        return _json({'time':time.time(), 'counts':index.counts(group)})
+    return {'/alarms':alarms, '/counts':counts}
+
+def _json(obj):
+    return 'application/json', json.dumps(obj, indent=1)
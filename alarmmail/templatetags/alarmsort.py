@@ -6,52 +6,77 @@ from django import template
 register = template.Library()
 
 class SbANode(template.Node):
-    def __init__(self, input, output, attrs):
-        self.input, self.output, self.attrs = input, output, attrs
+    def __init__(self, input, output, attrs, group=False):
+        self.input, self.output, self.attrs, self.group = input, output, attrs, group
     def render(self, context):
         input = self.input.resolve(context, True) # ignore failures
         out = self.output
         if not input:
             context[out] = []
-            return
-
-        def acmp(A, B):
-            for attr in self.attrs:
-                context[out] = A
-                aA = attr.resolve(context, True)
-                context[out] = B
-                aB = attr.resolve(context, True)
-                X = cmp(aA, aB)
-                if X!=0:
-                    return X
-            return 0
+            return ''
 
         input = list(input) # ensure list and make a copy
-        input.sort(cmp=acmp)
-        context[out] = input
-        return ''
 
-@register.tag
-def sortbyattr(parser, token):
-    """Sort the provide list by the attribute(s) of its elements
+        # resolve attributes once per element
+        keys = []
+        for item in input:
+            context[out] = item
+            keys.append(tuple([attr.resolve(context, True) for attr in self.attrs]))
 
-    {% sortbyattr alist attr1.name attr2.name as sortedlist %}
+        order = range(len(input))
+        order.sort(key=keys.__getitem__) # stable
+        output = [input[i] for i in order]
 
-    Will compare alist[0].attr1.name with alist[1].attr1.name
-    then compare alist[0].attr2.name with alist[1].attr2.name
-    """
+        if self.group:
+            # same as {% regroup output by attrs[0] as out %}
+            groups = []
+            for i in order:
+                K = keys[i][0]
+                if not groups or groups[-1]['grouper']!=K:
+                    groups.append({'grouper':K, 'list':[]})
+                groups[-1]['list'].append(input[i])
+            output = groups
+
+        context[out] = output
+        return ''
+
+def _parse(parser, token, group):
     parts = token.split_contents()
-    # [0] is 'sortbyattr'
+    # [0] is the tag name
     # [1] is the input variable name
     # [2:-2] are the attributes
     # [-2] is 'as'
     # [-1] is the output variable name
     if len(parts)<5:
-        raise template.TemplateSyntaxError('sortbyattr takes at least 5 arguments')
+        raise template.TemplateSyntaxError('%s takes at least 5 arguments'%parts[0])
     elif parts[-2] != 'as':
-        raise template.TemplateSyntaxError('sortbyattr expects assignment "as" not %s'%parts[-2])
+        raise template.TemplateSyntaxError('%s expects assignment "as" not %s'%(parts[0],parts[-2]))
     outvar = parts[-1]
     # Borrow a trick from the regroup tag.
     # Reuse our output variable as a temperary
     exprs = [parser.compile_filter('%s.%s'%(outvar,e)) for e in parts[2:-2]]
-    return SbANode(parser.compile_filter(parts[1]), outvar, exprs)
+    return SbANode(parser.compile_filter(parts[1]), outvar, exprs, group)
+
+@register.tag
+def sortbyattr(parser, token):
+    """Sort the provide list by the attribute(s) of its elements
+
+    {% sortbyattr alist attr1.name attr2.name as sortedlist %}
+
+    Will compare alist[0].attr1.name with alist[1].attr1.name
+    then compare alist[0].attr2.name with alist[1].attr2.name
+    """
+    return _parse(parser, token, False)
+
+@register.tag
+def sortgroupby(parser, token):
+    """Sort as with sortbyattr, then group by the first attribute
+
+    {% sortgroupby alist attr1.name attr2.name as groups %}
+
+    Is equivalent to
+
+    {% sortbyattr alist attr1.name attr2.name as sortedlist %}
+    {% regroup sortedlist by attr1.name as groups %}
+    """
+    return _parse(parser, token, True)
@@ -8,7 +8,9 @@ See license in README
 import logging
 LOG = logging.getLogger(__name__)
 
-import time, os
+import sys, time, os, math, heapq, threading
+
+from . import metrics
 
 def djangosetup(opts):
     if 'DJANGO_SETTINGS_MODULE' in os.environ:
@@ -39,46 +41,145 @@ class DummyValue(object):
     def __repr__(self):
         return "N/A"
 
+def plainvalue(V):
+    """Copy of a CA value without its meta-data attributes.
+    Strings are kept, numbers are kept unformatted (see fmtvalue())
+    """
+    if isinstance(V, str):
+        return str(V)
+    elif isinstance(V, float):
+        return float(V)
+    elif isinstance(V, (int, long)):
+        return int(V)
+    return str(V)
+
+def fmtvalue(V, enums=None, prec=None):
+    """String form of a value from plainvalue().  Enum values
+    are replaced by their strings, and floats use the precision,
+    when the FORMAT_CTRL meta-data is known.
+    """
+    if isinstance(V, str):
+        return V
+    elif enums and isinstance(V, int) and 0<=V<len(enums):
+        return enums[V]
+    elif prec is not None and isinstance(V, float):
+        return '%.*f'%(max(0, prec), V)
+    return str(V)
+
+def valuestr(V, meta=None):
+    """String form of a CA value, using meta-data if known
+    """
+    if meta is None:
+        return fmtvalue(plainvalue(V))
+    return fmtvalue(plainvalue(V), getattr(meta, 'enums', None), getattr(meta, 'precision', None))
+
 class AlarmEvent(object):
-    def __init__(self, data, meta, reason, conf):
+    """One alarm transition.
+
+    Only the fields used to render notifications are copied
+    from the CA value and meta-data, so that queued events
+    do not keep those objects alive.
+
+    When the meta-data is not yet known, lookup(name) is
+    called for it when the value or units are first read.
+    """
+    __slots__ = ('name', '_value', '_enums', '_prec', 'ok', 'sevr', 'status', 'timestamp', 'rxtimestamp',
+                 'reason', '_units', '_lookup', 'conf', 'suppressed', '_time', '_rxtime')
+    def __init__(self, data, meta, reason, conf, lookup=None):
         assert data is not None
-        self._data, self._meta, self.reason, self.conf = data, meta, reason, conf
+        self.name, self.ok = data.name, data.ok
+        # native type values are only formatted if rendered
+        self._value = plainvalue(data)
+        self._enums = self._prec = None
+        self._units, self._lookup = '', None
+        if meta is not None:
+            self._setmeta(meta)
+        elif data.ok:
+            self._lookup = lookup
+        self.reason, self.conf = reason, conf
+        self.suppressed = 0 # events not sent while flapping (RES_FLAPEND)
         self.rxtimestamp = time.time()
-        if not data.ok:
-            data.severity = 4
-            data.status = 0
-            data.timestamp = self.rxtimestamp
-    def __getattr__(self, key):
-        try:
-            return getattr(self._data, key)
-        except AttributeError:
-            return getattr(self._meta, key)
+        if data.ok:
+            self.sevr, self.status, self.timestamp = data.severity, data.status, data.timestamp
+        else:
+            self.sevr, self.status, self.timestamp = 4, 0, self.rxtimestamp
+        self._time = self._rxtime = None
+    def _setmeta(self, meta):
+        if not isinstance(self._value, str):
+            self._enums, self._prec = getattr(meta, 'enums', None), getattr(meta, 'precision', None)
+        self._units = getattr(meta, 'units', '')
+    def _resolve(self):
+        lookup, self._lookup = self._lookup, None
+        meta = lookup(self.name)
+        if meta is not None:
+            self._setmeta(meta)
     @property
-    def sevr(self):
-        return self._data.severity
+    def value(self):
+        V = self._value
+        if not isinstance(V, str):
+            if self._lookup is not None:
+                self._resolve()
+            V = self._value = fmtvalue(V, self._enums, self._prec)
+        return V
     @property
-    def severity(self):
-        return SEVR(self._data.severity)
+    def units(self):
+        if self._lookup is not None:
+            self._resolve()
+        return self._units
     @property
-    def value(self):
-        return self._data
+    def severity(self):
+        return SEVR(self.sevr)
     @property
     def time(self):
-        return time.ctime(self._data.timestamp)
+        if self._time is None:
+            self._time = time.ctime(self.timestamp)
+        return self._time
     @property
     def rxtime(self):
-        return time.ctime(self._data.rxtimestamp)
-    @property
-    def units(self):
-        try:
-            return self._meta.units
-        except:
-            return ''
+        if self._rxtime is None:
+            self._rxtime = time.ctime(self.rxtimestamp)
+        return self._rxtime
     @property
     def desc(self):
-        return self.conf.desc[self._data.name]
+        return self.conf.desc[self.name]
+    def totuple(self):
+        """Compact form to pass between processes.  The PV group name
+        stands in for conf.
+        """
+        return (self.name, self.value, self.ok, self.sevr, self.status, self.timestamp,
+                self.rxtimestamp, self.reason.code, self.units, self.conf.name, self.suppressed)
+    @classmethod
+    def fromtuple(cls, T, confs):
+        """Inverse of totuple().  confs is {group name:PVNode}
+        """
+        self = cls.__new__(cls)
+        (self.name, self._value, self.ok, self.sevr, self.status, self.timestamp,
+         self.rxtimestamp, code, self._units, group, self.suppressed) = T
+        self.reason, self.conf = REASONS[code], confs[group]
+        self._enums = self._prec = self._lookup = None
+        self._time = self._rxtime = None
+        return self
     def __repr__(self):
-        return 'AlarmEvent(\'%s\', %s, %s, %s)'%(self._data.name, self._data, self.severity, self.reason)
+        return 'AlarmEvent(\'%s\', %s, %s, %s)'%(self.name, self.value, self.severity, self.reason)
+
+class EventSummary(object):
+    """Coalesced record of the events for one PV
+    within one batch.  Other attributes are taken
+    from the most recent event.
+    """
+    __slots__ = ('first', 'last', 'worst', 'transitions')
+    def __init__(self, evt):
+        self.first = self.last = self.worst = evt
+        self.transitions = 1
+    def update(self, evt):
+        self.last = evt
+        if evt.sevr >= self.worst.sevr:
+            self.worst = evt
+        self.transitions += 1
+    def __getattr__(self, key):
+        return getattr(self.last, key)
+    def __repr__(self):
+        return 'EventSummary(%s, %d)'%(self.last, self.transitions)
 
 class InternalEvent(object):
     def __init__(self, reason):
@@ -108,29 +209,256 @@ RES_DISCONN = AlarmReason(4, "Connection lost")
 RES_QFULL = AlarmReason(5, "Queue full")
 RES_LOST = AlarmReason(6, "Lost Events")
 RES_START = AlarmReason(7, "Mailer starting")
+RES_FLAP = AlarmReason(8, "Flapping")
+RES_FLAPEND = AlarmReason(9, "Flapping stopped")
 
-class WorkerQueue(object):
-    _STOP = object()
-    def __init__(self, action=None, delay=1.0, holdoff=5.0, qsize=10):
+REASONS = dict([(R.code, R) for R in globals().values() if isinstance(R, AlarmReason)])
+
+def blocking(fn, *args, **kws):
+    """Call fn(*args, **kws) in a worker thread and wait for it
+    to complete while other cothreads continue to run.  Blocking
+    calls (eg. SMTP) are made through this so that they do not
+    stall CA callbacks.
+
+    Returns the result, or re-raises the exception, of fn().
+    """
+    import cothread
+    done = cothread.Event()
+    result = []
+    def run():
+        try:
+            result.append((True, fn(*args, **kws)))
+        except:
+            result.append((False, sys.exc_info()))
+        cothread.Callback(done.Signal)
+    T = threading.Thread(target=run, name=getattr(fn, '__name__', 'blocking'))
+    T.daemon = True
+    T.start()
+    done.Wait()
+    ok, val = result[0]
+    if ok:
+        return val
+    raise val[0], val[1], val[2]
+
+class Scheduler(object):
+    """Call functions at given times from one task.
+
+    Pending calls are kept in a heap ordered by deadline, so any
+    number of timers costs one sleeping task, which is woken only
+    for the earliest deadline.  Functions are called from the
+    scheduler task and must not block.
+    """
+    _default = None
+    def __init__(self):
         import cothread
-        holdoff -= delay
-        if holdoff <0.0:
-            holdoff = 0.0
-        self.delay, self.holdoff, self.qsize = delay, holdoff, qsize
-        self._Q, self.overflow, self._Qlim = [], False, qsize
-        self.waitn = cothread.Event(auto_reset=False)
-        self.sleep = cothread.Event(auto_reset=False)
-        self.T = cothread.Spawn(self._run)
+        self._heap, self._seq, self._ncancel = [], 0, 0
+        self._next = None # deadline being waited for
+        self._wake = cothread.Event()
+        self.nwakeups = 0
+        self._T = cothread.Spawn(self._run)
+
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def __len__(self):
+        return len(self._heap)-self._ncancel
+
+    def at(self, T, fn):
+        """Call fn() at time T.  Returns a handle for cancel()
+        """
+        self._seq += 1
+        E = [T, self._seq, fn]
+        heapq.heappush(self._heap, E)
+        if self._next is None or T<self._next:
+            self._wake.Signal()
+        return E
+
+    def cancel(self, E):
+        if E[2] is None:
+            return
+        E[2] = None
+        self._ncancel += 1
+        if self._ncancel>64 and self._ncancel>len(self._heap)//2:
+            self._heap[:] = [X for X in self._heap if X[2] is not None]
+            heapq.heapify(self._heap)
+            self._ncancel = 0
+
+    def _run(self):
+        from cothread import Timedout
+        while True:
+            now = self._next = time.time()
+            heap = self._heap
+            while heap and (heap[0][0]<=now or heap[0][2] is None):
+                _T, _seq, fn = heapq.heappop(heap)
+                if fn is None:
+                    self._ncancel -= 1
+                    continue
+                try:
+                    fn()
+                except:
+                    LOG.exception('Error from timer %s', fn)
+            self._next = heap[0][0] if heap else None
+            try:
+                self._wake.Wait(None if self._next is None else max(0.0, self._next-time.time()))
+            except Timedout:
+                pass
+            self.nwakeups += 1
+
+class WorkerQueue(object):
+    """Collect entries and process() them in batches.  Processing
+    waits 'delay' after the first entry, then at least 'holdoff' from
+    the first entry before the next batch.
+
+    In adaptive mode the rate of arrivals is tracked with an EWMA (time
+    constant 'delay') and the delay and holdoff move between 'mindelay'
+    and 'delay', and 'minholdoff' and 'holdoff'.  The maximum is
+    reached at a rate which would fill the queue within 'delay'.
+
+    Queues do not have their own task.  The delay and holdoff are
+    timers of the shared Scheduler, and each batch is processed by
+    a short lived task, so an idle queue costs nothing.
+    """
+    # _IDLE -> (add) -> _DELAY -> _BUSY (process()) -> _HOLDOFF -> _DELAY or _IDLE
+    _IDLE, _DELAY, _BUSY, _HOLDOFF = range(4)
+    def __init__(self, action=None, delay=1.0, holdoff=5.0, qsize=10, coalesce=False, name=None,
+                 adaptive=False, mindelay=None, minholdoff=None):
+        self._Q, self.overflow, self._idx = [], False, None
+        self._rate, self._rateT = 0.0, time.time()
+        self.name = name = name or self.__class__.__name__
+        R = metrics.REGISTRY
+        R.gauge('alarmmail_queue_depth', 'Entries waiting in queue',
+                fn=lambda:len(self._Q), queue=name)
+        self._m_overflow = R.counter('alarmmail_queue_overflow_total', 'Entries dropped because the queue was full', queue=name)
+        self._m_batch = R.summary('alarmmail_queue_batch_size', 'Entries per processed batch', queue=name)
+        self._m_time = R.summary('alarmmail_queue_process_seconds', 'Time to process one batch', queue=name)
+        R.gauge('alarmmail_queue_delay_seconds', 'Current batching delay',
+                fn=lambda:self._window()[0], queue=name)
+        self.configure(delay, holdoff, qsize, coalesce, adaptive, mindelay, minholdoff)
+        self._sched = Scheduler.default()
+        self._state, self._timer, self._flushreq = self._IDLE, None, False
+        self._closed, self._done = False, None
         if action:
             self.process = action
 
+    def configure(self, delay, holdoff, qsize, coalesce=False, adaptive=False, mindelay=None, minholdoff=None):
+        """Change settings.  Queued events are kept.
+        """
+        mindelay = delay if mindelay is None else min(mindelay, delay)
+        minholdoff = holdoff if minholdoff is None else min(minholdoff, holdoff)
+        holdoff = max(0.0, holdoff-delay)
+        minholdoff = max(0.0, minholdoff-mindelay)
+        self.delay, self.holdoff, self.qsize = delay, holdoff, qsize
+        self.adaptive, self.mindelay, self.minholdoff = adaptive, mindelay, minholdoff
+        self._tau = max(delay, 1e-3) # EWMA time constant
+        self._Qlim = qsize
+        # When coalescing, _Q holds one EventSummary per PV name
+        # and qsize limits the number of distinct PVs.
+        if coalesce and self._idx is None:
+            Q, self._Q, self._idx = self._Q, [], {}
+            for evt in Q:
+                self.add(evt)
+        elif not coalesce:
+            self._idx = None
+
     def close(self):
-        self.waitn.Signal(self._STOP)
-        self.sleep.Signal(self._STOP)
-        self.T.Wait()
+        """Stop, and process any queued entries before returning
+        """
+        self._closed = True
+        if self._timer is not None:
+            self._sched.cancel(self._timer)
+            self._timer = None
+        if self._state==self._BUSY:
+            import cothread
+            self._done = cothread.Event()
+            self._done.Wait()
+        self._state = self._IDLE
+        self._batch(self._take())
+        metrics.REGISTRY.remove(queue=self.name)
+
+    def flush(self):
+        """Process queued entries now instead of waiting
+        for the current delay or holdoff.
+        """
+        self._flushreq = True
+        if self._timer is not None:
+            self._sched.cancel(self._timer)
+            self._schedule(self._state, 0.0)
+
+    def _schedule(self, S, delay):
+        self._state = S
+        if self._flushreq:
+            delay = 0.0
+        self._timer = self._sched.at(time.time()+delay, self._expire)
+
+    def _expire(self):
+        """Called by the Scheduler at the end of a delay or holdoff
+        """
+        self._timer = None
+        if self._state==self._DELAY:
+            self._flushreq = False
+            self._state = self._BUSY
+            import cothread
+            cothread.Spawn(self._process, self._take())
+        elif self._Q and not self._closed:
+            self._schedule(self._DELAY, self._window()[0])
+        else:
+            self._state, self._flushreq = self._IDLE, False
+
+    def _process(self, Q):
+        self._batch(Q)
+        if self._done is not None:
+            # close() is waiting
+            self._state = self._IDLE
+            self._done.Signal()
+        else:
+            # Wait to enforce make rate
+            # The max. period is actually the sum of delay and holdoff
+            self._schedule(self._HOLDOFF, self._window()[1])
+
+    def _batch(self, Q):
+        if not Q:
+            return
+        T0 = time.time()
+        try:
+            self.process(Q, self.overflow)
+        except:
+            LOG.exception("%s Failed to process %d events",self,len(Q))
+        self._m_time.observe(time.time()-T0)
+        self._m_batch.observe(len(Q))
+
+    def rate(self, now=None):
+        """Average arrival rate (per second)
+        """
+        now = time.time() if now is None else now
+        return self._rate*math.exp(-max(0.0, now-self._rateT)/self._tau)
+
+    def _window(self):
+        """Returns the (delay, holdoff) to use now
+        """
+        if not self.adaptive:
+            return self.delay, self.holdoff
+        f = min(1.0, self.rate()*self._tau/max(1, self.qsize))
+        return (self.mindelay+(self.delay-self.mindelay)*f,
+                self.minholdoff+(self.holdoff-self.minholdoff)*f)
 
     def add(self, evt):
+        if self.adaptive:
+            now = time.time()
+            self._rate = self.rate(now)+1.0/self._tau
+            self._rateT = now
+
+        if self._idx is not None:
+            S = self._idx.get(evt.name)
+            if S is not None:
+                S.update(evt)
+                return True
+            evt = EventSummary(evt)
+
         if len(self._Q)>=self.qsize:
+            self._m_overflow.inc()
             if not self.overflow:
                 self.overflow = True
                 LOG.debug("%s queue overflow", self)
@@ -140,46 +468,23 @@ class WorkerQueue(object):
             self.overflow = False
 
         self._Q.append(evt)
-        self.waitn.Signal()
+        if self._idx is not None:
+            self._idx[evt.name] = evt
+        if self._state==self._IDLE and not self._closed:
+            self._schedule(self._DELAY, self._window()[0])
         return True
 
+    def _take(self):
+        """Remove and return the current batch
+        """
+        self._Q, Q = [], self._Q
+        if self._idx is not None:
+            self._idx = {}
+        return Q
+
     def process(self, Q, overflow):
         LOG.error("Ignoring %s (%s)",Q,overflow)
 
-    def _run(self):
-        import cothread
-        cevt = None # Control event
-        while not cevt or len(self._Q)!=0:
-            # Wait for first entry in queue
-            if not cevt:
-                cevt = self.waitn.Wait()
-
-            # Wait a while to batch up messages
-            try:
-                if not cevt:
-                    cevt = self.sleep.Wait(self.delay)
-            except cothread.Timedout:
-                pass
-
-            self._Q, Q = [], self._Q
-            self.waitn.Reset()
-
-            if not Q:
-                continue
-
-            try:
-                self.process(Q, self.overflow)
-            except:
-                LOG.exception("%s Failed to process %d events",self,len(Q))
-
-            # Wait to enforce make rate
-            # The max. period is actually the sum _BT + _SP
-            try:
-                if not cevt:
-                    cevt = self.sleep.Wait(self.holdoff)
-            except cothread.Timedout:
-                pass
-
 if __name__=='__main__':
     import cothread
     def action(Q,of):
@@ -0,0 +1,1161 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright 2014 Michael Davidsaver
+GPL 2+
+See license in README
+
+Unit tests using the simulated CA of alarmmail.simulate.
+Run from the top directory with
+
+  python -m unittest discover test
+"""
+
+import os, json, logging, marshal, shutil, smtplib, socket, struct, tempfile, threading, time, unittest, urllib2, atexit
+
+import cothread
+
+from alarmmail import capture, checkpoint, config, mailpool, main, metrics, notifier, pv, render, shard, simulate, spool, state, util
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_tdir = []
+def djangosetup():
+    """Configure django once.  Returns a temporary template directory,
+    which is searched before the top directory (default templates).
+    """
+    if not _tdir:
+        _tdir.append(tempfile.mkdtemp())
+        atexit.register(shutil.rmtree, _tdir[0])
+        class opts(object):
+            template = '%s:%s'%(_tdir[0], TOP)
+        util.djangosetup(opts)
+    return _tdir[0]
+
+def group(name, pvs, **kws):
+    return config.PVNode(config.SectionProxy.fromArgs(name, pvs=' '.join(pvs), **kws))
+
+class Collect(object):
+    """Stand in for NotifyFanout
+    """
+    def __init__(self):
+        self.evts = []
+    def add(self, evt):
+        self.evts.append(evt)
+        return True
+    def reasons(self):
+        return [E.reason for E in self.evts]
+
+class SimTest(unittest.TestCase):
+    def setUp(self):
+        self.ca = simulate.FakeCA()
+        simulate.install(self.ca)
+        self._index, state.INDEX = state.INDEX, state.AlarmIndex()
+        self.registry = pv.Registry()
+
+    def tearDown(self):
+        self.registry.close()
+        simulate.install(None)
+        state.INDEX = self._index
+        # unittest keeps each TestCase until the end of the run
+        del self.registry, self.ca
+
+    def subscribe(self, conf, notify, names):
+        pv.subscribe(self.registry.add(conf, notify, names))
+        cothread.Sleep(0.01) # initial updates
+
+    def post(self, name, sevr):
+        self.ca.post(simulate.SimValue(str(sevr), name, severity=sevr, status=sevr and 3))
+
+class TestPV(SimTest):
+    def test_reconnect(self):
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a']), N, ['pv:a'])
+        P = self.registry['pv:a']
+
+        self.post('pv:a', 2)
+        self.ca.disconnect('pv:a')
+        self.assertEqual(P._code, state.DISCONN)
+        self.post('pv:a', 0)
+        self.assertEqual(P._code, 0)
+        # still subscribed after reconnecting
+        self.post('pv:a', 1)
+        self.ca.disconnect('pv:a')
+        self.post('pv:a', 2)
+
+        self.assertEqual(N.reasons(), [util.RES_ALARM, util.RES_DISCONN, util.RES_NORMAL,
+                                       util.RES_ALARM, util.RES_DISCONN, util.RES_DECREASE])
+        self.assertEqual([E.sevr for E in N.evts], [2, 4, 0, 1, 4, 2])
+
+class TestOptions(SimTest):
+    def test_configure(self):
+        """New monitor options apply to existing PVs
+        """
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a', 'pv:b']), N, ['pv:a', 'pv:b'])
+        self.assertFalse(self.registry.configure(pv.Options(logburst=1)))
+        self.assertEqual(self.registry['pv:a']._opts.logburst, 1)
+
+        self.assertTrue(self.registry.configure(pv.Options(alarmonly=True)))
+        cothread.Sleep(0.01)
+        subs = self.ca._subs['pv:a']+self.ca._subs['pv:b']
+        self.assertEqual([S.events for S in subs], [self.ca.DBE_ALARM]*2)
+        self.post('pv:a', 1)
+        self.assertEqual(N.reasons(), [util.RES_ALARM])
+
+class TestDigest(unittest.TestCase):
+    def test_bounded(self):
+        """Only PVs left in alarm are summarized between digests
+        """
+        node = group('grp', ['pv:%d'%i for i in range(1000)])
+        D = notifier.DigestNotifier(config.DestNode(config.SectionProxy.fromArgs('dig',
+                to='me@x.invalid', groups='grp', mode='digest', period='3600')), None)
+        sent = []
+        D.process = lambda evts, overflow, **extra:sent.append((len(evts), extra['transitions']))
+        try:
+            for i in range(1000):
+                for S in (2, 0) if i%100 else (2,):
+                    D.add(util.AlarmEvent(simulate.SimValue(str(S), 'pv:%d'%i, severity=S), None,
+                                          util.RES_ALARM if S else util.RES_NORMAL, node))
+            self.assertEqual(len(D._summ), 10)
+            self.assertEqual(D._ntrans, 1990)
+        finally:
+            D.close()
+        self.assertEqual(sent, [(0, 1990)])
+
+class TestDigestExit(SimTest):
+    def test_exit(self):
+        """The digest sent at exit lists the PVs still in alarm
+        """
+        djangosetup()
+        D = main.AlarmDaemon(daemonconfig({'grp':['pv:a', 'pv:b']}, mode='digest', period='3600'))
+        sent = []
+        try:
+            D.start(Progress())
+            D.notifiers['dest'].process = lambda evts, overflow, **extra:sent.append(
+                                            ([E.name for E in evts], extra['transitions']))
+            self.post('pv:a', 2)
+            cothread.Sleep(0.01)
+        finally:
+            D.close()
+        self.assertEqual(sent, [(['pv:a'], 1)])
+
+class TestFlap(SimTest):
+    def test_suppressed(self):
+        """The number of events suppressed is reported when flapping stops
+        """
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a'], flapHigh='3', flapLow='0', flapWindow='0.5'), N, ['pv:a'])
+        for S in (1, 0, 1, 0, 1, 0):
+            self.post('pv:a', S)
+        cothread.Sleep(1.0)
+        self.assertEqual(N.reasons(), [util.RES_ALARM, util.RES_NORMAL, util.RES_FLAP, util.RES_FLAPEND])
+        evt = N.evts[-1]
+        self.assertEqual(evt.suppressed, 3)
+        self.assertEqual(util.AlarmEvent.fromtuple(evt.totuple(), {'grp':evt.conf}).suppressed, 3)
+
+        djangosetup()
+        text = render.CachingLoader().render_to_string('template.txt', {'events':[evt]})
+        self.assertIn('(3 events suppressed while flapping)', text)
+
+def event(name, sevr, node=None, value=None):
+    V = simulate.SimValue(str(sevr if value is None else value), name, severity=sevr, status=sevr and 3,
+                          timestamp=time.time())
+    return util.AlarmEvent(V, None, util.RES_ALARM if sevr else util.RES_NORMAL, node)
+
+class TestCoalesce(unittest.TestCase):
+    def test_flood(self):
+        """A flood of transitions on fewer PVs is kept as one summary per PV
+        """
+        batches = []
+        Q = util.WorkerQueue(lambda evts, overflow:batches.append((evts, overflow)),
+                             delay=3600.0, qsize=1000, coalesce=True, name='test')
+        for n in range(10000):
+            Q.add(event('pv:%d'%(n%1000), [1, 2, 0][(n//1000)%3]))
+        self.assertEqual(len(Q._Q), 1000)
+        Q.add(event('pv:other', 1)) # one PV too many
+        Q.close()
+
+        [(evts, overflow)] = batches
+        self.assertTrue(overflow)
+        self.assertEqual(len(evts), 1000)
+        self.assertEqual(sum([S.transitions for S in evts]), 10000)
+        S = evts[0]
+        self.assertEqual((S.first.sevr, S.worst.sevr, S.last.sevr), (1, 2, 1))
+
+class TestConnect(SimTest):
+    def test_ready(self):
+        """Setup ends as soon as all PVs have connected
+        """
+        names = ['pv:%d'%i for i in range(5000)]
+        T0 = time.time()
+        new = self.registry.add(group('grp', names), Collect(), names)
+        pv.subscribe(new)
+        self.assertEqual(pv.waitconnect(new, 30.0, settle=5.0), 5000)
+        self.assertLess(time.time()-T0, 5.0)
+
+    def test_settle(self):
+        """Setup ends when the number connected stops rising
+        """
+        names = ['pv:%d'%i for i in range(100)]
+        self.ca.offline.update(names[:10])
+        new = self.registry.add(group('grp', names), Collect(), names)
+        pv.subscribe(new)
+        T0 = time.time()
+        self.assertEqual(pv.waitconnect(new, 30.0, settle=0.5), 90)
+        self.assertLess(time.time()-T0, 5.0)
+
+class Progress(object):
+    def msg(self, msg):
+        pass
+
+def daemonconfig(groups, **destkws):
+    """Configuration as from config.loadconfig() with one destination
+    for the PV groups {name:[pv name]}
+    """
+    S = config.SectionProxy.fromArgs
+    destkws.setdefault('delay', '3600')
+    return {'main':S('main', initialwait='10', initialsettle='5'),
+            'mail':S('mail', nosend='True'),
+            'pv':dict([(G, group(G, names)) for G, names in groups.iteritems()]),
+            'dest':{'dest':config.DestNode(S('dest', to='me@x.invalid', groups=' '.join(sorted(groups)),
+                                               **destkws))}}
+
+class TestReload(SimTest):
+    def test_reload(self):
+        """Reload time depends on the size of the change, not of the configuration
+        """
+        djangosetup()
+        names = ['pv:%d'%i for i in range(50000)]
+        D = main.AlarmDaemon(daemonconfig({'one':names[:30000], 'two':names[20000:]}))
+        try:
+            T0 = time.time()
+            D.start(Progress())
+            Tstart = time.time()-T0
+            self.assertEqual(len(self.ca._subs), 50000)
+            P, N = D.registry['pv:1'], D.notifiers['dest']
+            N.add(event('pv:1', 1, D.C['pv']['one']))
+
+            T0 = time.time()
+            D.reload(daemonconfig({'one':names[1:30000]+['pv:new'], 'two':names[20000:]}))
+            Treload = time.time()-T0
+            cothread.Sleep(0.01)
+
+            subs = self.ca._subs
+            self.assertEqual(len([K for K, V in subs.iteritems() if V]), 50000)
+            self.assertFalse(subs['pv:0'])
+            self.assertTrue(subs['pv:new'])
+            # unchanged PVs and destinations are kept, with queued events
+            self.assertIs(D.registry['pv:1'], P)
+            self.assertIs(D.notifiers['dest'], N)
+            self.assertEqual(len(N._Q), 1)
+            self.assertLess(Treload, Tstart/10)
+        finally:
+            D.close()
+
+class TestShard(SimTest):
+    def test_partition(self):
+        """Each PV goes to one worker, whichever groups list it
+        """
+        names = ['pv:%d'%i for i in range(1000)]
+        C = {'pv':{'one':group('one', names[:600]), 'two':group('two', names[400:])}}
+        parts = shard.partition(C, 4)
+        owner = {}
+        for idx, part in enumerate(parts):
+            self.assertTrue(part)
+            for G, L in part.iteritems():
+                for name in L:
+                    self.assertEqual(owner.setdefault(name, idx), idx)
+        self.assertEqual(sorted(owner), sorted(names))
+
+    def test_records(self):
+        """Events and PV state pass from a worker to the aggregator
+        """
+        recs = []
+        class Pipe(object):
+            send = recs.append
+        C = {'pv':{'one':group('one', ['pv:a', 'pv:b']), 'two':group('two', ['pv:b'])}}
+        state.INDEX = shard.ForwardIndex(Pipe())
+        sink = shard.EventSink(Pipe())
+        for G in sorted(C['pv']):
+            pv.subscribe(self.registry.add(C['pv'][G], sink, C['pv'][G].pvs))
+        cothread.Sleep(0.01)
+        self.post('pv:a', 1)
+        self.post('pv:b', 2)
+
+        state.INDEX = state.AlarmIndex()
+        fanouts = {'one':Collect(), 'two':Collect()}
+        agg = shard.Aggregator([], C, fanouts)
+        agg.dispatch(marshal.loads(marshal.dumps(recs)))
+        self.assertEqual([(E.name, E.sevr) for E in fanouts['one'].evts], [('pv:a', 1), ('pv:b', 2)])
+        self.assertEqual([(E.name, E.sevr) for E in fanouts['two'].evts], [('pv:b', 2)])
+        self.assertEqual(state.INDEX.counts(), {'one':{'No Alarm':0, 'Minor':1, 'Major':1, 'Invalid':0, 'Disconn.':0},
+                                                'two':{'No Alarm':0, 'Minor':0, 'Major':1, 'Invalid':0, 'Disconn.':0}})
+
+class TestMonitor(SimTest):
+    def setUp(self):
+        SimTest.setUp(self)
+        self.registry.opts = pv.Options(alarmonly=True, native=True)
+
+    def subscribe(self, conf, notify, names):
+        pv.subscribe(self.registry.add(conf, notify, names), self.registry.opts)
+        cothread.Sleep(0.01)
+
+    def test_alarmonly(self):
+        """Value changes without a change of alarm state are not delivered
+        """
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a']), N, ['pv:a'])
+        N0 = pv._M_UPDATES.value
+        for n in range(100):
+            self.ca.post(simulate.SimNumber(n, 'pv:a', severity=(n//10)%2, status=0))
+        self.assertEqual(pv._M_UPDATES.value-N0, 9) # the first matches the initial value
+        self.assertEqual(len(N.evts), 9)
+
+    def test_native(self):
+        """Native values are formatted with the display precision when rendered
+        """
+        class Meta(object):
+            precision, units = 2, 'V'
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a']), N, ['pv:a'])
+        self.registry['pv:a']._meta = Meta()
+        self.ca.post(simulate.SimNumber(1.23456, 'pv:a', severity=1, status=3))
+        [evt] = N.evts
+        self.assertEqual(evt.value, '1.23')
+        self.assertEqual(evt.units, 'V')
+
+    def test_latemeta(self):
+        """Events queued while the meta-data is being fetched use it when rendered
+        """
+        class Meta(simulate.SimValue):
+            enums, precision, units = ('Off', 'On', 'Fault', 'Trip'), 2, 'V'
+        class SimEnum(int):
+            ok, severity, status, timestamp = True, 2, 3, 0.0
+        self.ca.caget = lambda names, **kws:[Meta('', name) for name in names]
+        fetcher = pv.MetaFetcher(delay=0.1)
+        self.registry.close()
+        self.registry = pv.Registry(fetcher, pv.Options(native=True))
+        try:
+            N = Collect()
+            self.subscribe(group('grp', ['pv:a', 'pv:b']), N, ['pv:a', 'pv:b'])
+            V = SimEnum(3)
+            V.name = 'pv:a'
+            self.ca.post(V)
+            self.ca.post(simulate.SimNumber(1.23456, 'pv:b', severity=1, status=3))
+            self.assertIsNone(self.registry['pv:a']._meta) # still fetching
+            cothread.Sleep(0.3)
+            self.assertEqual([(E.value, E.units) for E in N.evts], [('Trip', 'V'), ('1.23', 'V')])
+        finally:
+            fetcher.close()
+
+class TestMeta(SimTest):
+    def setUp(self):
+        SimTest.setUp(self)
+        self.calls, self.fail, self.stall = [], set(), 0.0
+        self.ca.caget = self.caget
+        self.fetcher = None
+
+    def tearDown(self):
+        if self.fetcher is not None:
+            self.fetcher.close()
+        SimTest.tearDown(self)
+
+    def caget(self, names, **kws):
+        self.calls.append(len(names))
+        if self.stall:
+            cothread.Sleep(self.stall) # as catools, other cothreads run meanwhile
+        ret = []
+        for name in names:
+            M = simulate.SimValue('', name, units='V', fetched=time.time())
+            if name in self.fail:
+                M.ok = False
+            ret.append(M)
+        return ret
+
+    def test_batch(self):
+        """Requests are gathered, and fetched in batches
+        """
+        self.fetcher = F = pv.MetaFetcher(delay=0.05, batch=100)
+        got = []
+        for n in range(250):
+            self.assertIsNone(F.get('pv:%d'%n, got.append))
+        F.get('pv:0', got.append) # same callback only once
+        cothread.Sleep(0.2)
+        self.assertEqual(self.calls, [100, 100, 50])
+        self.assertEqual(sorted([M.name for M in got]), sorted(['pv:%d'%n for n in range(250)]))
+        self.assertEqual(F.get('pv:0', got.append).units, 'V')
+        cothread.Sleep(0.1)
+        self.assertEqual(self.calls, [100, 100, 50])
+
+    def test_ttl(self):
+        """An expired entry is returned while it is fetched again
+        """
+        self.fetcher = F = pv.MetaFetcher(ttl=0.2, delay=0.05)
+        got = []
+        F.get('pv:a', got.append)
+        cothread.Sleep(0.1)
+        [M] = got
+        cothread.Sleep(0.2)
+        self.assertIs(F.get('pv:a', got.append), M) # expired
+        cothread.Sleep(0.1)
+        self.assertEqual(self.calls, [1, 1])
+        self.assertIsNot(got[-1], M)
+        self.assertIs(F.get('pv:a', got.append), got[-1])
+
+    def test_fail(self):
+        """Nothing is cached or called back for a failed fetch,
+        and the next get() tries again.
+        """
+        self.fetcher = F = pv.MetaFetcher(delay=0.05)
+        self.fail.add('pv:b')
+        got = []
+        F.get('pv:a', got.append)
+        F.get('pv:b', got.append)
+        cothread.Sleep(0.1)
+        self.assertEqual([M.name for M in got], ['pv:a'])
+        self.assertIsNone(F.cached('pv:b'))
+
+        self.fail.clear()
+        self.assertIsNone(F.get('pv:b', got.append))
+        cothread.Sleep(0.1)
+        self.assertEqual([M.name for M in got], ['pv:a', 'pv:b'])
+        self.assertEqual(self.calls, [2, 1])
+
+    def test_reconnect(self):
+        """A mass reconnect does not wait for meta-data, and cached
+        meta-data is used again after reconnecting
+        """
+        self.stall = 0.5
+        self.fetcher = pv.MetaFetcher(delay=0.05)
+        self.registry.close()
+        self.registry = pv.Registry(self.fetcher)
+        names = ['pv:%d'%n for n in range(2000)]
+        N = Collect()
+        self.subscribe(group('grp', names), N, names)
+        cothread.Sleep(2*self.stall+0.2) # two batches
+        self.assertEqual(self.calls, [1000, 1000])
+
+        T0 = time.time()
+        for name in names:
+            self.ca.disconnect(name)
+        for name in names:
+            self.post(name, 1)
+        T = time.time()-T0
+        self.assertEqual(len(N.evts), 4000)
+        self.assertLess(T, 0.5*self.stall)
+        self.assertEqual(self.registry['pv:1']._meta.units, 'V')
+        self.assertEqual(N.evts[-1].units, 'V')
+        cothread.Sleep(0.1)
+        self.assertEqual(self.calls, [1000, 1000])
+
+class TestRegistry(SimTest):
+    def test_groups(self):
+        """A PV in several groups has one subscription, and events for each group
+        """
+        one, two = group('one', ['pv:a', 'pv:b']), group('two', ['pv:b'])
+        N1, N2 = Collect(), Collect()
+        self.subscribe(one, N1, ['pv:a', 'pv:b'])
+        self.subscribe(two, N2, ['pv:b'])
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(len(self.ca._subs['pv:b']), 1)
+
+        self.post('pv:b', 2)
+        self.assertEqual([(E.name, E.conf.name) for E in N1.evts], [('pv:b', 'one')])
+        self.assertEqual([(E.name, E.conf.name) for E in N2.evts], [('pv:b', 'two')])
+        self.assertEqual(state.INDEX.counts()['two']['Major'], 1)
+
+        # removed from one group, still in the other
+        self.assertEqual(self.registry.remove('one', ['pv:b']), 0)
+        self.assertEqual(len(self.ca._subs['pv:b']), 1)
+        self.post('pv:b', 0)
+        self.assertEqual(len(N1.evts), 1)
+        self.assertEqual(N2.reasons(), [util.RES_ALARM, util.RES_NORMAL])
+        self.assertEqual(state.INDEX.counts()['one']['No Alarm'], 1)
+
+        # removed from the last group
+        self.assertEqual(self.registry.remove('two', ['pv:b']), 1)
+        self.assertEqual(self.ca._subs['pv:b'], [])
+        self.assertNotIn('two', state.INDEX.counts())
+
+class TestLanes(unittest.TestCase):
+    def test_flood(self):
+        """A Major alarm is mailed within the lane delay during a flood of Minor alarms
+        """
+        node = group('grp', ['pv:%d'%i for i in range(1000)])
+        D = notifier.Notifier(config.DestNode(config.SectionProxy.fromArgs('dest',
+                to='me@x.invalid', groups='grp', delay='3600', queueSize='50',
+                lanes='urgent:2', urgentDelay='0.1', urgentHoldoff='1')), None)
+        sent = []
+        D.process = lambda evts, overflow, **extra:sent.append((time.time(), extra.get('lane'), evts, overflow))
+        try:
+            for i in range(500):
+                D.add(event('pv:%d'%i, 1, node))
+            T0 = time.time()
+            self.assertTrue(D.add(event('pv:major', 2, node)))
+            for i in range(500, 1000):
+                D.add(event('pv:%d'%i, 1, node))
+            self.assertTrue(D.overflow)
+            cothread.Sleep(0.5)
+            [(T, lane, evts, _overflow)] = sent
+            self.assertEqual(lane, 'urgent')
+            self.assertEqual([E.name for E in evts], ['pv:major'])
+            self.assertLess(T-T0, 0.5)
+        finally:
+            D.close()
+        # Minor alarms are sent on close
+        self.assertEqual([(L, len(E)) for _T, L, E, _O in sent], [('urgent', 1), (None, 50)])
+
+class TestAdaptive(unittest.TestCase):
+    def test_bounds(self):
+        """The window moves between its limits with the arrival rate
+        """
+        Q = util.WorkerQueue(lambda evts, overflow:None, delay=10.0, holdoff=30.0, qsize=100,
+                             adaptive=True, mindelay=1.0, minholdoff=5.0, name='test')
+        try:
+            # holdoff is counted from the start of the delay
+            self.assertEqual(Q._window(), (1.0, 4.0))
+            W = []
+            for n in range(200):
+                Q.add(n)
+                W.append(Q._window())
+            for D, H in W:
+                self.assertTrue(1.0<=D<=10.0 and 4.0<=H<=20.0, (D, H))
+            self.assertEqual([D for D, H in W], sorted([D for D, H in W]))
+            self.assertEqual(W[-1], (10.0, 20.0))
+            del Q._Q[:]
+        finally:
+            Q.close()
+
+    def test_latency(self):
+        """Quiet periods give low latency, storms give fewer mails
+        """
+        def run(nevts, period):
+            batches = []
+            Q = util.WorkerQueue(lambda evts, overflow:batches.append((time.time(), evts)),
+                                 delay=1.0, holdoff=2.0, qsize=100,
+                                 adaptive=True, mindelay=0.05, minholdoff=0.1, name='test')
+            try:
+                for n in range(nevts):
+                    Q.add(time.time())
+                    cothread.Sleep(period)
+                cothread.Sleep(0.2)
+            finally:
+                Q.close()
+            return len(batches), max([T-E for T, evts in batches for E in evts])
+
+        nmails, latency = run(5, 0.3)
+        self.assertEqual(nmails, 5)
+        self.assertLess(latency, 0.25)
+
+        nmails, latency = run(200, 0.0)
+        self.assertEqual(nmails, 2)
+
+class TestScheduler(unittest.TestCase):
+    def test_order(self):
+        """Calls are made in deadline order, and cancel() removes them
+        """
+        S, calls, done = util.Scheduler(), [], cothread.Event()
+        now = time.time()
+        for dT in (0.3, 0.1, 0.2, 0.05):
+            S.at(now+dT, lambda dT=dT:calls.append(dT))
+        E = S.at(now+0.15, lambda:calls.append('cancelled'))
+        S.at(now+0.4, done.Signal)
+        self.assertEqual(len(S), 6)
+        S.cancel(E)
+        S.cancel(E)
+        self.assertEqual(len(S), 5)
+        done.Wait(2.0)
+        self.assertEqual(calls, [0.05, 0.1, 0.2, 0.3])
+        self.assertEqual(len(S), 0)
+
+    def test_wakeups(self):
+        """Many idle queues cost no wakeups until a deadline
+        """
+        S = util.Scheduler.default()
+        cothread.Yield()
+        base, wakeups = len(S), S.nwakeups
+        nprocessed = [0]
+        def process(evts, overflow):
+            nprocessed[0] += len(evts)
+        Qs = [util.WorkerQueue(process, delay=0.5, holdoff=1.0, qsize=10, name='test%d'%n)
+              for n in range(1000)]
+        try:
+            for Q in Qs:
+                Q.add(1)
+                Q.add(2)
+            cothread.Sleep(0.2)
+            self.assertLessEqual(S.nwakeups-wakeups, 2)
+            self.assertEqual(nprocessed[0], 0)
+
+            cothread.Sleep(1.5)
+            self.assertEqual(nprocessed[0], 2000)
+            self.assertEqual(len(S), base)
+        finally:
+            for Q in Qs:
+                Q.close()
+
+class TestRoutes(SimTest):
+    def test_alarms(self):
+        """/alarms and /counts report the state index
+        """
+        class Meta(object):
+            precision, units = 2, 'V'
+        self.registry.opts = pv.Options(native=True)
+        N = Collect()
+        for G, names in (('one', ['pv:a', 'pv:b', 'pv:c', 'pv:d']), ('two', ['pv:b'])):
+            pv.subscribe(self.registry.add(group(G, names), N, names), self.registry.opts)
+        cothread.Sleep(0.01)
+        self.registry['pv:a']._meta = Meta()
+        self.ca.post(simulate.SimNumber(1.23456, 'pv:a', severity=2, status=3, timestamp=10.0))
+        self.ca.post(simulate.SimNumber(2.0, 'pv:b', severity=1, status=4, timestamp=20.0))
+        self.ca.disconnect('pv:c')
+
+        R = state.routes(state.INDEX)
+        def alarms(**query):
+            ctype, body = R['/alarms'](dict([(K, [V]) for K, V in query.items()]))
+            self.assertEqual(ctype, 'application/json')
+            return json.loads(body)
+
+        A = alarms()
+        self.assertEqual([(E['name'], E['group'], E['severity']) for E in A['alarms']],
+                         [('pv:c', 'one', 'Disconn.'), ('pv:a', 'one', 'Major'),
+                          ('pv:b', 'one', 'Minor'), ('pv:b', 'two', 'Minor')])
+        self.assertEqual(A['alarms'][0]['value'], None)
+        self.assertEqual(A['alarms'][1], {'name':'pv:a', 'group':'one', 'severity':'Major', 'sevr':2,
+                                          'status':3, 'value':'1.23', 'timestamp':10.0})
+        self.assertEqual(A['alarms'][2]['value'], '2.0')
+        self.assertEqual(A['counts'], {'one':{'No Alarm':1, 'Minor':1, 'Major':1, 'Invalid':0, 'Disconn.':1},
+                                       'two':{'No Alarm':0, 'Minor':1, 'Major':0, 'Invalid':0, 'Disconn.':0}})
+
+        self.assertEqual([E['name'] for E in alarms(min='2')['alarms']], ['pv:c', 'pv:a'])
+        self.assertEqual(len(alarms(min='x')['alarms']), 4)
+        A = alarms(group='two')
+        self.assertEqual([E['name'] for E in A['alarms']], ['pv:b'])
+        self.assertEqual(A['counts'].keys(), ['two'])
+        A = alarms(group='none')
+        self.assertEqual((A['alarms'], A['counts']),
+                         ([], {'none':dict.fromkeys(['No Alarm', 'Minor', 'Major', 'Invalid', 'Disconn.'], 0)}))
+
+        ctype, body = R['/counts']({'group':['one']})
+        self.assertEqual(json.loads(body)['counts'], {'one':{'No Alarm':1, 'Minor':1, 'Major':1, 'Invalid':0, 'Disconn.':1}})
+
+class TestCheckpoint(SimTest):
+    def setUp(self):
+        SimTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SimTest.tearDown(self)
+
+    def test_disconnected(self):
+        """A PV disconnected at exit reports 'Alarm cleared' when
+        it reconnects without alarm after a restart.
+        """
+        fname = os.path.join(self.dir, 'ckp')
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a']), N, ['pv:a'])
+        self.ca.disconnect('pv:a')
+        checkpoint.save(fname, checkpoint.snapshot(self.registry.itervalues()))
+        self.registry.close()
+
+        saved = checkpoint.load(fname)
+        self.assertEqual(saved['pv:a'].severity, state.DISCONN)
+        self.ca = simulate.FakeCA()
+        simulate.install(self.ca)
+        N = Collect()
+        new = self.registry.add(group('grp', ['pv:a']), N, ['pv:a'])
+        checkpoint.seed(new, saved)
+        pv.subscribe(new)
+        cothread.Sleep(0.01)
+        self.assertEqual(N.reasons(), [util.RES_NORMAL])
+
+    def test_alarminitial(self):
+        """With alarminitial, PVs in alarm when first connecting are reported,
+        and PVs seeded from a checkpoint report only changes since the restart.
+        """
+        names = ['pv:a', 'pv:b', 'pv:c']
+        self.post('pv:a', 2)
+        N = Collect()
+        self.subscribe(group('grp', names, alarminitial='True'), N, names)
+        self.assertEqual([(E.name, E.reason) for E in N.evts], [('pv:a', util.RES_ALARM)])
+
+        self.post('pv:c', 1)
+        fname = os.path.join(self.dir, 'ckp')
+        checkpoint.save(fname, checkpoint.snapshot(self.registry.itervalues()))
+        self.registry.close()
+
+        last = self.ca._last
+        self.ca = simulate.FakeCA()
+        self.ca._last.update(last)
+        simulate.install(self.ca)
+        self.post('pv:b', 1) # changed while stopped
+        self.post('pv:c', 0)
+        N = Collect()
+        new = self.registry.add(group('grp', names, alarminitial='True'), N, names)
+        checkpoint.seed(new, checkpoint.load(fname))
+        pv.subscribe(new)
+        cothread.Sleep(0.01)
+        self.assertEqual(sorted([(E.name, E.reason) for E in N.evts]),
+                         [('pv:b', util.RES_ALARM), ('pv:c', util.RES_NORMAL)])
+
+    def test_noinitial(self):
+        """Without alarminitial, PVs in alarm when first connecting are not reported
+        """
+        self.post('pv:a', 2)
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a']), N, ['pv:a'])
+        self.assertEqual(N.evts, [])
+
+class LogRecords(logging.Handler):
+    def __init__(self, name):
+        logging.Handler.__init__(self)
+        self.records, self.logger = [], logging.getLogger(name)
+        self.logger.addHandler(self)
+    def emit(self, record):
+        self.records.append(record)
+    def close(self):
+        self.logger.removeHandler(self)
+        logging.Handler.close(self)
+
+class TestCapture(SimTest):
+    def setUp(self):
+        SimTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        pv._capture = None
+        shutil.rmtree(self.dir)
+        SimTest.tearDown(self)
+
+    def test_replay(self):
+        """Updates captured across several files are replayed
+        to give the same events
+        """
+        names = ['pv:a', 'pv:b']
+        pv._capture = C = capture.CaptureLog(self.dir, filesize=200, nfiles=100, bufsize=1, period=60.0)
+        N = Collect()
+        self.subscribe(group('grp', names), N, names)
+        for n in range(10):
+            self.post('pv:a', n%3)
+            if n%4==1:
+                self.ca.disconnect('pv:b')
+            else:
+                self.post('pv:b', 2-n%3)
+        pv._capture = None
+        C.close()
+        self.assertGreater(len(N.evts), 5)
+
+        files = capture.CaptureLog.files(self.dir)
+        self.assertGreater(len(files), 2)
+        recs = []
+        for fname in files:
+            # each file can be read alone, as names are written again
+            V = list(capture.read(fname))
+            self.assertTrue(V)
+            recs.extend(V)
+        self.assertEqual(len(recs), 22) # with the initial updates
+        disc = [V for V in recs if not V.ok]
+        self.assertEqual([V.name for V in disc], ['pv:b']*3)
+
+        self.ca = simulate.FakeCA()
+        simulate.install(self.ca)
+        registry, self.registry = self.registry, pv.Registry()
+        registry.close()
+        N2 = Collect()
+        self.subscribe(group('grp', names), N2, names)
+        for _T, V in capture.replay(self.dir, speed=1e6):
+            self.ca.post(V)
+        self.assertEqual([(E.name, E.reason, E.sevr) for E in N2.evts],
+                         [(E.name, E.reason, E.sevr) for E in N.evts])
+
+    def test_truncated(self):
+        """A partial record at the end of a file is ignored with a warning
+        """
+        C = capture.CaptureLog(self.dir, period=60.0)
+        for n in range(3):
+            C.record(simulate.SimValue(str(n), 'pv:a', severity=1, timestamp=float(n)))
+        C.close()
+        [fname] = capture.CaptureLog.files(self.dir)
+        with open(fname, 'ab') as FP:
+            FP.write('U\0\0')
+        L = LogRecords('alarmmail.capture')
+        try:
+            self.assertEqual([V.timestamp for V in capture.read(fname)], [0.0, 1.0, 2.0])
+        finally:
+            L.close()
+        [R] = L.records
+        self.assertEqual(R.levelno, logging.WARNING)
+        self.assertIn('truncated', R.getMessage())
+
+class BrokenSMTP(object):
+    """SMTP session which fails with an unexpected error for some recipients
+    """
+    def __init__(self, *args, **kws):
+        pass
+    def sendmail(self, mfrom, mto, msg):
+        if msg=='bad':
+            raise UnicodeEncodeError('ascii', u'', 0, 1, 'test')
+        return {}
+    def quit(self):
+        pass
+    def close(self):
+        pass
+
+class StalledSMTP(object):
+    """SMTP session which takes 'stall' seconds to send each mail
+    """
+    stall = 2.0
+    def __init__(self, *args, **kws):
+        self.sent = []
+    def sendmail(self, mfrom, mto, msg):
+        time.sleep(self.stall)
+        self.sent.append(time.time())
+        return {}
+    def quit(self):
+        pass
+    def close(self):
+        pass
+
+class TestStall(SimTest):
+    def test_ingest(self):
+        """CA updates are handled while the SMTP server stalls
+        """
+        N = Collect()
+        self.subscribe(group('grp', ['pv:a']), N, ['pv:a'])
+        S = notifier.EmailServer(config.SectionProxy.fromArgs('mail', delay='0', holdoff='0'))
+        conn = StalledSMTP()
+        S._transport = lambda *args, **kws:conn
+        try:
+            S.add(('me@x.invalid', ['you@x.invalid'], 'msg'), urgent=True)
+            T0 = last = time.time()
+            gap, nupdate = 0.0, 0
+            while time.time()-T0 < StalledSMTP.stall+0.5:
+                cothread.Sleep(0.01)
+                now = time.time()
+                gap, last = max(gap, now-last), now
+                nupdate += 1
+                self.post('pv:a', nupdate%2)
+            self.assertEqual(len(conn.sent), 1)
+            self.assertGreaterEqual(conn.sent[0]-T0, StalledSMTP.stall)
+            self.assertLess(gap, 0.2)
+            self.assertEqual(len(N.evts), nupdate)
+        finally:
+            S.close()
+
+class TestSMTP(unittest.TestCase):
+    def check(self, concurrency):
+        S = notifier.EmailServer(config.SectionProxy.fromArgs('mail', concurrency=str(concurrency)))
+        try:
+            S._transport = BrokenSMTP
+            retry = S._send([('me@x.invalid', ['a@one.invalid'], 'ok'),
+                             ('me@x.invalid', ['b@two.invalid'], 'bad'),
+                             ('me@x.invalid', ['c@two.invalid'], 'ok')])
+        finally:
+            S.close()
+        # the rest of the failed domain is retried, and not counted as sent
+        self.assertEqual(retry, [[], ['b@two.invalid'], ['c@two.invalid']])
+
+    def test_unexpected(self):
+        self.check(1)
+
+    def test_unexpected_threads(self):
+        self.check(2)
+
+class FakeSession(object):
+    """Stand-in for an smtplib.SMTP session.  Calls are logged
+    as (session number, method).
+    """
+    def __init__(self, log, n):
+        self.log, self.n, self.alive = log, n, True
+    def noop(self):
+        self.log.append((self.n, 'noop'))
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return (250, 'OK')
+    def sendmail(self, mfrom, mto, msg):
+        self.log.append((self.n, 'sendmail'))
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return {}
+    def quit(self):
+        self.log.append((self.n, 'quit'))
+        if not self.alive:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+    def close(self):
+        self.log.append((self.n, 'close'))
+
+class TestPool(unittest.TestCase):
+    def setUp(self):
+        self.log, self.conns = [], []
+        self.pool = mailpool.SMTPPool(self.connect, size=2, idletime=60.0, checktime=5.0)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def connect(self):
+        C = FakeSession(self.log, len(self.conns))
+        self.conns.append(C)
+        return C
+
+    def age(self, dT):
+        self.pool._idle = [(T-dT, C) for T, C in self.pool._idle]
+
+    def test_reuse(self):
+        """A session used recently is handed out again without a NOOP
+        """
+        C = self.pool.get()
+        self.pool.put(C)
+        self.assertIs(self.pool.get(), C)
+        self.assertEqual(self.log, [])
+
+    def test_check(self):
+        """A session idle for more than checktime is probed with NOOP
+        """
+        C = self.pool.get()
+        self.pool.put(C)
+        self.age(10.0)
+        self.assertIs(self.pool.get(), C)
+        self.assertEqual(self.log, [(0, 'noop')])
+
+    def test_stale(self):
+        """A session which fails NOOP is dropped, and a new one opened
+        """
+        C = self.pool.get()
+        self.pool.put(C)
+        self.age(10.0)
+        C.alive = False
+        C2 = self.pool.get()
+        self.assertIsNot(C2, C)
+        self.assertEqual(len(self.conns), 2)
+        self.assertEqual(self.log, [(0, 'noop'), (0, 'close')])
+
+    def test_expire(self):
+        """Sessions idle for idletime are closed with QUIT
+        """
+        A, B = self.pool.get(), self.pool.get()
+        self.pool.put(A)
+        self.pool.put(B)
+        self.age(30.0)
+        self.pool._idle[-1] = (time.time(), B) # B used since
+        self.pool.expire(time.time()+30.0)
+        self.assertEqual(self.log, [(0, 'quit')])
+        self.assertIs(self.pool.get(), B)
+
+    def test_size(self):
+        """Sessions returned beyond 'size' are closed with QUIT
+        """
+        conns = [self.pool.get() for i in range(3)]
+        for C in conns:
+            self.pool.put(C)
+        self.assertEqual(self.log, [(2, 'quit')])
+        conns[2].alive = False
+        self.pool.put(conns[2]) # QUIT fails
+        self.assertEqual(self.log[1:], [(2, 'quit'), (2, 'close')])
+
+    def test_server(self):
+        """EmailServer keeps one session across batches, and replaces
+        one which the server has closed.
+        """
+        S = notifier.EmailServer(config.SectionProxy.fromArgs('mail', checkTime='0'))
+        S._pool = self.pool
+        S._transport = lambda *args, **kws:self.connect()
+        try:
+            mail = ('me@x.invalid', ['you@x.invalid'], 'msg')
+            S._send([mail])
+            S._send([mail])
+            self.assertEqual(len(self.conns), 1)
+            self.conns[0].alive = False
+            self.age(10.0)
+            self.assertEqual(S._send([mail]), [[]])
+            self.assertEqual(len(self.conns), 2)
+        finally:
+            S.close()
+
+class DeferSMTP(FakeSession):
+    """Session which defers mail to the recipients in 'defer'
+    """
+    def __init__(self, defer):
+        FakeSession.__init__(self, [], 0)
+        self.defer = defer
+    def __call__(self, *args, **kws):
+        return self
+    def sendmail(self, mfrom, mto, msg):
+        self.log.append(list(mto))
+        return dict([(R, (451, 'try later')) for R in mto if R in self.defer])
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def msgs(self, S, limit=100):
+        return [msg for (_mfrom, _mto, msg), _pos in S.peek(limit)]
+
+    def test_reopen(self):
+        """Undelivered mail is replayed when the spool is opened again
+        """
+        S = spool.MailSpool(self.dir)
+        for n in range(3):
+            S.append('me@x.invalid', ['you@x.invalid'], 'msg%d'%n)
+        S.commit(S.peek(1)[-1][1])
+        S.close()
+
+        S = spool.MailSpool(self.dir)
+        try:
+            self.assertEqual(S.pending, 2)
+            self.assertEqual(self.msgs(S), ['msg1', 'msg2'])
+        finally:
+            S.close()
+
+    def test_torn(self):
+        """A partial record at the end of the last segment is truncated
+        """
+        S = spool.MailSpool(self.dir)
+        S.append('me@x.invalid', ['you@x.invalid'], 'msg0')
+        S.append('me@x.invalid', ['you@x.invalid'], 'msg1')
+        S.close()
+        [seg] = [F for F in os.listdir(self.dir) if F.endswith('.spool')]
+        seg = os.path.join(self.dir, seg)
+        size = os.path.getsize(seg)
+        with open(seg, 'ab') as FP:
+            FP.write(struct.pack('!I', 100)+'torn')
+
+        S = spool.MailSpool(self.dir)
+        try:
+            self.assertEqual(S.pending, 2)
+            self.assertEqual(os.path.getsize(seg), size)
+            S.append('me@x.invalid', ['you@x.invalid'], 'msg2')
+            self.assertEqual(self.msgs(S), ['msg0', 'msg1', 'msg2'])
+        finally:
+            S.close()
+
+    def test_rotate(self):
+        """The cursor follows records across segments, and
+        delivered segments are deleted.
+        """
+        S = spool.MailSpool(self.dir, segsize=100)
+        try:
+            for n in range(5):
+                S.append('me@x.invalid', ['you@x.invalid'], 'msg%d'%n+'x'*80)
+            segs = lambda:sorted([F for F in os.listdir(self.dir) if F.endswith('.spool')])
+            self.assertEqual(len(segs()), 6) # one record each, and an empty segment
+            recs = S.peek(3)
+            self.assertEqual([R[0][2][:4] for R in recs], ['msg0', 'msg1', 'msg2'])
+            S.commit(recs[-1][1])
+            self.assertEqual(segs(), ['%08d.spool'%n for n in range(2, 6)])
+            self.assertEqual(S.pending, 2)
+            self.assertEqual([msg[:4] for msg in self.msgs(S)], ['msg3', 'msg4'])
+        finally:
+            S.close()
+        S = spool.MailSpool(self.dir, segsize=100)
+        try:
+            self.assertEqual(S.pending, 2)
+            self.assertEqual(segs(), ['%08d.spool'%n for n in range(2, 6)])
+            self.assertEqual([msg[:4] for msg in self.msgs(S)], ['msg3', 'msg4'])
+        finally:
+            S.close()
+
+    def test_retry(self):
+        """Deferred recipients are spooled again, and retried with
+        exponential backoff.
+        """
+        S = notifier.EmailServer(config.SectionProxy.fromArgs('mail', spool=self.dir, delay='3600',
+                                                              retryMin='30', retryMax='100'))
+        conn = S._transport = DeferSMTP(['later@b.invalid'])
+        try:
+            S._spool.append('me@x.invalid', ['ok@a.invalid'], 'msg0')
+            S._spool.append('me@x.invalid', ['ok@b.invalid', 'later@b.invalid'], 'msg1')
+            backoff = []
+            for n in range(4):
+                S._processspool()
+                backoff.append(S._backoff)
+                self.assertGreater(S._retryat, time.time()+backoff[-1]-1.0)
+                self.assertEqual(S._processspool(), None) # waiting
+                S._retryat = 0.0
+            self.assertEqual(backoff, [30.0, 60.0, 100.0, 100.0])
+            self.assertEqual(sorted(conn.log[:2]), [['ok@a.invalid'], ['ok@b.invalid', 'later@b.invalid']])
+            self.assertEqual(conn.log[2:], [['later@b.invalid']]*3)
+            self.assertEqual(S._spool.pending, 1)
+            self.assertEqual(S._spool.peek(1)[0][0][1], ['later@b.invalid'])
+
+            conn.defer = []
+            S._processspool()
+            self.assertEqual(S._backoff, 0.0)
+            self.assertEqual(S._spool.pending, 0)
+        finally:
+            S.close()
+
+class TestRender(unittest.TestCase):
+    def setUp(self):
+        self.dir = djangosetup()
+
+    def write(self, name, text, mtime=None):
+        fname = os.path.join(self.dir, name)
+        with open(fname, 'w') as FP:
+            FP.write(text)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+
+    def test_include(self):
+        """A variable used only by an included template changes the output
+        """
+        self.write('top.txt', '{{ events|length }} {% include "inc.txt" %}')
+        self.write('inc.txt', '{{ notifier }}')
+        L = render.CachingLoader()
+        evts = [1, 2]
+        self.assertEqual(L.render_to_string('top.txt', {'events':evts, 'notifier':'one'}), '2 one')
+        self.assertEqual(L.render_to_string('top.txt', {'events':evts, 'notifier':'two'}), '2 two')
+
+    def test_recompile(self):
+        self.write('change.txt', 'old', mtime=1000)
+        L = render.CachingLoader()
+        self.assertEqual(L.render_to_string('change.txt', {}), 'old')
+        self.write('change.txt', 'new', mtime=2000)
+        self.assertEqual(L.render_to_string('change.txt', {}), 'new')
+
+    def test_sortgroupby(self):
+        """sortgroupby gives the same groups as sortbyattr and regroup,
+        keeping the input order of equal elements
+        """
+        loop = '{% for G in groups %}{{ G.grouper }}:{% for E in G.list %}{{ E.n }},{% endfor %};{% endfor %}'
+        self.write('sgb.txt', '{% load alarmsort %}{% sortgroupby events grp sevr as groups %}'+loop)
+        self.write('regroup.txt', '{% load alarmsort %}{% sortbyattr events grp sevr as sorted %}'
+                                  '{% regroup sorted by grp as groups %}'+loop)
+        class E(object):
+            def __init__(self, n, grp, sevr):
+                self.n, self.grp, self.sevr = n, grp, sevr
+        evts = [E(n, 'grp%d'%(n%3), n%2) for n in range(20)]
+        L = render.CachingLoader()
+        for events in (evts, evts[::-1], [], None):
+            out = L.render_to_string('sgb.txt', {'events':events})
+            self.assertEqual(out, L.render_to_string('regroup.txt', {'events':events}))
+        self.assertEqual(L.render_to_string('sgb.txt', {'events':evts[:6]}), 'grp0:0,3,;grp1:4,1,;grp2:2,5,;')
+        self.assertEqual(L.render_to_string('sgb.txt', {'events':[]}), '')
+
+class TestMetrics(unittest.TestCase):
+    def test_stalled_client(self):
+        """A client which sends nothing stalls neither other clients nor cothreads
+        """
+        serv = metrics.serve(0, routes={'/x':lambda query:('text/plain', 'x=%s'%query['a'][0])})
+        try:
+            stall = socket.create_connection(('127.0.0.1', serv.server_port))
+            result = []
+            def get():
+                result.append(urllib2.urlopen('http://127.0.0.1:%d/x?a=1'%serv.server_port, timeout=5).read())
+            T = threading.Thread(target=get)
+            T.start()
+            T0 = time.time()
+            while not result and time.time()-T0<5.0:
+                cothread.Sleep(0.01)
+            self.assertLess(time.time()-T0, 1.0)
+            self.assertEqual(result, ['x=1'])
+            T.join()
+            stall.close()
+        finally:
+            serv.server_close()
+
+if __name__=='__main__':
+    unittest.main()